@@ -1,6 +1,8 @@
 from django.contrib import admin
-from .models import ChatLog,Participant,Assistant
+from .models import ChatLog,Participant,Assistant,TurnRequest,TokenUsage
 
 admin.site.register(Participant)
 admin.site.register(Assistant)
-admin.site.register(ChatLog)
\ No newline at end of file
+admin.site.register(ChatLog)
+admin.site.register(TurnRequest)
+admin.site.register(TokenUsage)
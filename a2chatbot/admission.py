@@ -0,0 +1,160 @@
+"""
+Admission control for OpenAI calls.
+
+Every OpenAI request made by the views goes through `governor.acquire(...)`,
+which keeps this process under its share of the account's requests-per-minute
+and tokens-per-minute quotas. Callers that cannot be served right away wait in
+a bounded priority queue (in-progress turns first, then new registrations,
+then background prefetching). If the queue is full, the lowest-priority
+waiter makes room for a more urgent caller; if nobody waiting ranks below
+the caller, or the wait would be longer than OPENAI_MAX_WAIT, the caller gets
+`Overloaded` straight away with a retry hint instead of piling up.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from django.conf import settings
+
+from a2chatbot import metrics
+
+# Lower value = served first.
+TURN = 0
+REGISTRATION = 1
+PREFETCH = 2
+PRIORITY_NAMES = {TURN: "turn", REGISTRATION: "registration", PREFETCH: "prefetch"}
+
+QUEUE_DEPTH = metrics.Gauge(
+    "a2chatbot_openai_queue_depth",
+    "OpenAI calls currently waiting for admission.",
+)
+REJECTED = metrics.Counter(
+    "a2chatbot_openai_rejected_total",
+    "OpenAI calls rejected by admission control.",
+    ("priority",),
+)
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(f"OpenAI capacity exhausted, retry in {self.retry_after}s")
+
+
+def estimate_tokens(*texts, completion=0):
+    """
+    Rough token count (~4 characters per token) used for TPM accounting.
+    """
+    return sum(len(t) for t in texts if t) // 4 + completion
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class Governor:
+    def __init__(self, rpm, tpm, max_queue, max_wait):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._evicted = set()
+        self._seq = itertools.count()
+
+    @classmethod
+    def from_settings(cls):
+        workers = max(1, getattr(settings, "OPENAI_WORKER_PROCESSES", 1))
+        return cls(
+            rpm=getattr(settings, "OPENAI_RPM", 500) / workers,
+            tpm=getattr(settings, "OPENAI_TPM", 200000) / workers,
+            max_queue=getattr(settings, "OPENAI_MAX_QUEUE", 50),
+            max_wait=getattr(settings, "OPENAI_MAX_WAIT", 10.0),
+        )
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._waiting)
+
+    def acquire(self, priority=TURN, tokens=0):
+        """
+        Block until one request and `tokens` tokens are available.
+        Raises Overloaded if that cannot happen within max_wait.
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                self._make_room(priority)
+
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            QUEUE_DEPTH.set(len(self._waiting))
+            try:
+                while True:
+                    if ticket in self._evicted:
+                        self._evicted.discard(ticket)
+                        self._reject(priority, len(self._waiting) / self.requests.rate)
+                    now = time.monotonic()
+                    remaining = deadline - now
+                    if self._waiting[0] == ticket:
+                        self.requests.refill(now)
+                        self.tokens.refill(now)
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                        if wait <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(tokens)
+                            return
+                        if wait > remaining:
+                            self._reject(priority, wait)
+                    else:
+                        if remaining <= 0:
+                            position = sum(1 for t in self._waiting if t <= ticket)
+                            self._reject(priority, position / self.requests.rate)
+                        wait = remaining
+                    self._cond.wait(min(wait, remaining))
+            finally:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                QUEUE_DEPTH.set(len(self._waiting))
+                self._cond.notify_all()
+
+    def _make_room(self, priority):
+        """
+        Queue full: evict the lowest-priority (newest) waiter if it ranks
+        below `priority`, otherwise reject the caller. Called with the lock held.
+        """
+        worst = max(self._waiting)
+        if worst[0] <= priority:
+            self._reject(priority, len(self._waiting) / self.requests.rate)
+        self._waiting.remove(worst)
+        heapq.heapify(self._waiting)
+        self._evicted.add(worst)
+        self._cond.notify_all()
+
+    def _reject(self, priority, retry_after):
+        REJECTED.inc(1, PRIORITY_NAMES.get(priority, str(priority)))
+        raise Overloaded(retry_after)
+
+
+governor = Governor.from_settings()
@@ -0,0 +1,124 @@
+"""
+Precomputed per-question artifacts.
+
+Everything tutor mode needs about a question that doesn't depend on the
+student is built once per QA file instead of on every request:
+- the ground-truth embedding (used by the local fallback grader)
+- the transcript chunks most relevant to the question and its answer
+
+Each topic gets <name>.npz (vectors) and <name>.json (chunks and a hash of
+the QA set they were built from) in QUESTION_ARTIFACTS_DIR.
+`manage.py seed_global_mutations` builds them after seeding the transcript.
+A topic only loads them on the request path; see Topic.artifacts().
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from a2chatbot.vectorstore import EMBEDDING_MODEL, embed_text
+
+# Bump when the stored format or what goes into it changes
+ARTIFACT_VERSION = 2
+QUESTION_CHUNKS = 3
+
+_build_lock = threading.Lock()
+
+
+def artifacts_dir():
+    return getattr(
+        settings,
+        "QUESTION_ARTIFACTS_DIR",
+        os.path.join(os.path.dirname(__file__), "data", "artifacts"),
+    )
+
+
+def qa_digest(qa):
+    return hashlib.sha1(json.dumps(qa, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class QuestionArtifacts:
+    def __init__(self, questions, ground_truth_vectors):
+        self.questions = questions
+        self.ground_truth_vectors = ground_truth_vectors
+
+    def chunks(self, index):
+        return self.questions[index]["chunks"]
+
+    def ground_truth_vector(self, index):
+        return self.ground_truth_vectors[index]
+
+
+def _paths(name, directory):
+    base = os.path.join(directory, name)
+    return base + ".json", base + ".npz"
+
+
+def build(topic, directory=None):
+    """
+    Compute and store the artifacts for every question of `topic`.
+    """
+    directory = directory or artifacts_dir()
+    qa = topic.qa
+    truths = np.asarray(embed_text([q["answer"] for q in qa]), dtype=np.float32)
+
+    # Retrieve for question + answer together: the chunks that explain it
+    focus = embed_text([f"{q['question']} {q['answer']}" for q in qa])
+    results = topic.collection().query(query_embeddings=focus, n_results=QUESTION_CHUNKS)
+    documents = results.get("documents") or [[] for _ in qa]
+
+    questions = [
+        {
+            "question": q["question"],
+            "chunks": list(docs),
+        }
+        for q, docs in zip(qa, documents)
+    ]
+    meta = {
+        "version": ARTIFACT_VERSION,
+        "model": EMBEDDING_MODEL,
+        "collection": topic.collection_name,
+        "qa_sha1": qa_digest(qa),
+        "questions": questions,
+    }
+
+    os.makedirs(directory, exist_ok=True)
+    json_path, npz_path = _paths(topic.name, directory)
+    with _build_lock:
+        # Write to temporary files and rename, so readers never see half a store
+        with open(npz_path + ".tmp", "wb") as f:
+            np.savez_compressed(f, ground_truth=truths)
+        with open(json_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(npz_path + ".tmp", npz_path)
+        os.replace(json_path + ".tmp", json_path)
+    return QuestionArtifacts(questions, truths)
+
+
+def load(topic, directory=None):
+    """
+    The stored artifacts for `topic`, or None if missing or built from a
+    different QA set, embedding model or format.
+    """
+    json_path, npz_path = _paths(topic.name, directory or artifacts_dir())
+    try:
+        with open(json_path) as f:
+            meta = json.load(f)
+        with np.load(npz_path) as data:
+            truths = data["ground_truth"]
+    except (OSError, ValueError, KeyError):
+        return None
+    if (
+        meta.get("version") != ARTIFACT_VERSION
+        or meta.get("model") != EMBEDDING_MODEL
+        or meta.get("collection") != topic.collection_name
+        or meta.get("qa_sha1") != qa_digest(topic.qa)
+        or len(truths) != len(topic.qa)
+    ):
+        return None
+    return QuestionArtifacts(meta["questions"], truths)
+
@@ -0,0 +1,90 @@
+"""
+Post-retrieval compression of transcript context.
+
+Retrieved chunks are ~300 words each, most of which has nothing to do with
+the student's message, and every token of them is paid for on each run (and
+again in the thread history). `compress` splits the chunks into sentences,
+scores each sentence against the query with the local embedding model, and
+picks sentences MMR-style (relevant, but not repeating what is already
+picked) until the token budget is spent. The kept sentences stay in
+transcript order.
+"""
+
+import re
+
+import numpy as np
+
+from a2chatbot import metrics
+from a2chatbot.admission import estimate_tokens
+from a2chatbot.vectorstore import embed_text
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+# Video timestamps ("1:03") left in the transcript between sentences
+TIMESTAMP = re.compile(r"\b\d{1,2}:\d{2}\b\s*")
+# Sentences this similar to one already kept add nothing
+DUPLICATE_SIMILARITY = 0.92
+
+TOKENS_RETRIEVED = metrics.Counter(
+    "a2chatbot_rag_tokens_retrieved_total",
+    "Estimated tokens of transcript context retrieved, before compression.",
+)
+TOKENS_SAVED = metrics.Counter(
+    "a2chatbot_rag_tokens_saved_total",
+    "Estimated prompt tokens removed by context compression.",
+)
+
+
+def split_sentences(passage):
+    passage = TIMESTAMP.sub("", passage)
+    return [s.strip() for s in SENTENCE_SPLIT.split(passage) if s.strip()]
+
+
+def compress(query, passages, budget, mmr_lambda=0.7):
+    """
+    Return (context_text, tokens_before, tokens_after).
+    """
+    original = "\n\n".join(passages)
+    tokens_before = estimate_tokens(original)
+    TOKENS_RETRIEVED.inc(tokens_before)
+    if tokens_before <= budget:
+        return original, tokens_before, tokens_before
+
+    sentences = []  # (passage index, position, text)
+    for p, passage in enumerate(passages):
+        for i, sentence in enumerate(split_sentences(passage)):
+            sentences.append((p, i, sentence))
+    if not sentences:
+        return original, tokens_before, tokens_before
+
+    with metrics.span("rag_compress"):
+        vectors = np.asarray(embed_text([query] + [s[2] for s in sentences]), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-9
+        relevance = vectors[1:] @ vectors[0]
+        similarity = vectors[1:] @ vectors[1:].T
+        costs = [estimate_tokens(s[2]) + 1 for s in sentences]
+
+        chosen = []
+        used = 0
+        redundancy = np.zeros(len(sentences), dtype=np.float32)
+        available = np.ones(len(sentences), dtype=bool)
+        while available.any():
+            scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+            scores[~available] = -np.inf
+            best = int(np.argmax(scores))
+            available[best] = False
+            if used + costs[best] > budget:
+                continue
+            if chosen and redundancy[best] >= DUPLICATE_SIMILARITY:
+                continue
+            chosen.append(best)
+            used += costs[best]
+            redundancy = np.maximum(redundancy, similarity[best])
+
+    by_passage = {}
+    for index in sorted(chosen, key=lambda j: sentences[j][:2]):
+        by_passage.setdefault(sentences[index][0], []).append(sentences[index][2])
+    text = "\n\n".join(" ".join(kept) for _, kept in sorted(by_passage.items()))
+    tokens_after = estimate_tokens(text)
+
+    TOKENS_SAVED.inc(tokens_before - tokens_after)
+    return text, tokens_before, tokens_after
@@ -0,0 +1,75 @@
+"""
+Correctness grading of a student's answer against the ground truth: the
+OpenAI eval prompt, and the embedding-similarity grader used when OpenAI is
+unavailable. Shared by tutor mode and `manage.py grade_answers`.
+"""
+
+import re
+
+from django.conf import settings
+
+from a2chatbot import admission, prompts
+from a2chatbot.llm import client, openai_call
+from a2chatbot.vectorstore import embed_text
+
+
+# evaluate_correctness' default: hedge after OPENAI_HEDGE_EVAL_AFTER
+FROM_SETTINGS = object()
+
+
+def evaluate_correctness(ground_truth, studentmessage, hedge_after=FROM_SETTINGS, circuit=None):
+    """
+    Classify the student's answer against the ground truth with a small model.
+    `hedge_after` (None = no hedging) and `circuit` are passed to openai_call.
+    """
+    if hedge_after is FROM_SETTINGS:
+        hedge_after = getattr(settings, "OPENAI_HEDGE_EVAL_AFTER", None)
+    messages = prompts.eval_messages(ground_truth, studentmessage)
+
+    eval_resp = openai_call(
+        "eval",
+        client.chat.completions.create,
+        tokens=admission.estimate_tokens(*(m["content"] for m in messages), completion=10),
+        hedge_after=hedge_after,
+        circuit=circuit,
+        model="gpt-4o-mini",
+        messages=messages,
+        max_tokens=10
+    )
+    return eval_resp.choices[0].message.content.strip().lower()
+
+
+# ---------- Local grader (used when OpenAI is unavailable) ----------
+
+IDK_PATTERN = re.compile(r"\b(i\s*do?n'?t\s+know|idk|no idea|not sure)\b", re.IGNORECASE)
+
+
+# Minimum similarity to the ground truth for "correct" / "partially correct"
+FALLBACK_THRESHOLDS = (0.75, 0.5)
+
+
+def label_from_similarity(studentmessage, similarity, thresholds=FALLBACK_THRESHOLDS):
+    if IDK_PATTERN.search(studentmessage):
+        return "idk"
+    if similarity >= thresholds[0]:
+        return "correct"
+    if similarity >= thresholds[1]:
+        return "partially correct"
+    return "incorrect"
+
+
+def fallback_label(ground_truth, studentmessage, truth_vector=None):
+    """
+    Rough correctness label from embedding similarity to the ground truth
+    (`truth_vector` is its precomputed embedding, if available).
+    """
+    if IDK_PATTERN.search(studentmessage):
+        return "idk"
+    if truth_vector is not None:
+        truth = [float(x) for x in truth_vector]
+        (answer,) = embed_text([studentmessage])
+    else:
+        truth, answer = embed_text([ground_truth, studentmessage])
+    dot = sum(a * b for a, b in zip(truth, answer))
+    norm = (sum(a * a for a in truth) * sum(b * b for b in answer)) ** 0.5
+    return label_from_similarity(studentmessage, dot / norm if norm else 0.0)
@@ -0,0 +1,40 @@
+"""
+The shared OpenAI client and the helper every OpenAI call goes through.
+"""
+
+import os
+import time
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from a2chatbot import admission, metrics, resilience, usage
+
+load_dotenv()
+# Retries are handled by a2chatbot.resilience, not the SDK.
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+
+def openai_call(stage, fn, priority=admission.TURN, tokens=0, hedge_after=None, circuit=None, **kwargs):
+    """
+    Make one OpenAI API call under admission control and the resilience
+    policy (deadline, retries, circuit breaker), timed as `stage`.
+    Raises admission.Overloaded if there is no capacity for it and
+    resilience.Unavailable if OpenAI could not answer in time.
+    """
+    def attempt(timeout):
+        started = time.monotonic()
+        with metrics.span("admission_wait"):
+            admission.governor.acquire(priority, tokens)
+        # Time spent queued comes out of the stage's deadline
+        remaining = timeout - (time.monotonic() - started)
+        if remaining <= 0:
+            raise resilience.AdmissionDeadlineExceeded(f"{stage} waited past its deadline for admission")
+        resilience.request_sent()
+        with metrics.span(stage):
+            response = fn(timeout=remaining, **kwargs)
+        # Per attempt, so the unused half of a hedged call is counted too
+        usage.record(stage, response)
+        return response
+
+    return resilience.call(stage, attempt, hedge_after=hedge_after, circuit=circuit)
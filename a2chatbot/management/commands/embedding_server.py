@@ -0,0 +1,60 @@
+import os
+import socketserver
+import threading
+
+from django.core.management.base import BaseCommand
+
+from a2chatbot import vectorstore
+
+
+class EmbeddingHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A client may send several requests over one connection
+        while True:
+            try:
+                texts = vectorstore.read_texts(self.request)
+            except ConnectionError:
+                return
+            try:
+                with self.server.model_lock:
+                    vectors = vectorstore.encode_locally(texts)
+                reply = vectorstore.pack_vectors(vectors)
+            except Exception as e:
+                reply = vectorstore.pack_error(str(e))
+            self.request.sendall(reply)
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(path, EmbeddingHandler)
+        self.model_lock = threading.Lock()
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the shared embedding server: one process holds the embedding model "
+        "and answers embed_text requests from all Django workers over a Unix socket."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=vectorstore.EMBEDDING_SOCKET)
+
+    def handle(self, *args, **options):
+        path = options["socket"]
+
+        # Load the model before accepting connections
+        vectorstore.get_model()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        with EmbeddingServer(path) as server:
+            os.chmod(path, 0o660)
+            self.stdout.write(self.style.SUCCESS(f"Embedding server listening on {path}"))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(path)
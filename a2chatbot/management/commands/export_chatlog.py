@@ -0,0 +1,199 @@
+import csv
+import json
+import os
+import sys
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Max
+from django.db.models.fields.json import KeyTextTransform
+
+from a2chatbot.models import ChatLog
+
+EXPORT_FIELDS = ["id", "user_id", "timestamp", "message", "bot_reply", "meta"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Streams ChatLog to JSONL/CSV and computes per-question correctness, "
+        "turns-to-mastery and mode usage. With --checkpoint, only rows added "
+        "since the previous run are processed and the aggregates are carried over."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="Export file ('-' for stdout). Omit to only aggregate.")
+        parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+        parser.add_argument("--include-context", action="store_true",
+                            help="Also export the retrieved transcript context (large).")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument("--checkpoint", help="JSON file holding the last processed id and running aggregates.")
+        parser.add_argument("--report", help="Write the aggregate report here instead of stdout.")
+
+    def handle(self, *args, **options):
+        state = self.load_checkpoint(options["checkpoint"])
+
+        rows = ChatLog.objects.filter(id__gt=state["last_id"])
+        # Fix the upper bound so rows inserted while we run wait for next time
+        upto = rows.aggregate(upto=Max("id"))["upto"]
+        if upto is not None:
+            rows = rows.filter(id__lte=upto)
+
+            if options["output"]:
+                exported = self.export(rows, options, state)
+                self.stderr.write(f"Exported {exported} rows")
+
+            self.count_in_db(rows, state)
+            self.track_mastery(rows, state, options["chunk_size"])
+            state["last_id"] = upto
+
+        if options["checkpoint"]:
+            self.save_checkpoint(options["checkpoint"], state)
+
+        report = json.dumps(self.build_report(state), indent=2)
+        if options["report"]:
+            with open(options["report"], "w") as f:
+                f.write(report + "\n")
+        else:
+            self.stdout.write(report)
+
+    # ---------- checkpoint ----------
+
+    def load_checkpoint(self, path):
+        state = {
+            "last_id": 0, "modes": {}, "labels": {}, "open": {}, "mastered": {}, "done": [], "export": None,
+        }
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    state.update(json.load(f))
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read checkpoint {path}: {e}")
+        return state
+
+    def save_checkpoint(self, path, state):
+        # Write and rename, so a crash never leaves half a checkpoint
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    # ---------- export ----------
+
+    def export(self, rows, options, state):
+        fields = EXPORT_FIELDS + (["context"] if options["include_context"] else [])
+        stream = rows.order_by("id").values(*fields).iterator(chunk_size=options["chunk_size"])
+
+        # Append when resuming from a checkpoint, so the file accumulates
+        path = options["output"]
+        mode = "a" if options["checkpoint"] and os.path.exists(path) else "w"
+        out = sys.stdout if path == "-" else open(path, mode, newline="")
+        count = 0
+        try:
+            # Drop rows written after the last saved checkpoint (a run that
+            # stopped before saving it): they are exported again below
+            exported = state["export"]
+            if mode == "a" and exported and exported["path"] == os.path.abspath(path):
+                out.truncate(exported["bytes"])
+            if options["format"] == "csv":
+                writer = csv.DictWriter(out, fieldnames=fields)
+                if mode == "w":
+                    writer.writeheader()
+                for row in stream:
+                    row["meta"] = json.dumps(row["meta"])
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in stream:
+                    out.write(json.dumps(row, default=str) + "\n")
+                    count += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if out is not sys.stdout:
+            state["export"] = {"path": os.path.abspath(path), "bytes": os.path.getsize(path)}
+        return count
+
+    # ---------- aggregates ----------
+
+    def count_in_db(self, rows, state):
+        """
+        Mode usage and per-question label counts, grouped by the database.
+        """
+        by_mode = (
+            rows.annotate(mode=KeyTextTransform("mode", "meta"))
+            .values("mode")
+            .annotate(turns=Count("id"))
+        )
+        modes = Counter(state["modes"])
+        for row in by_mode:
+            modes[row["mode"] or "unknown"] += row["turns"]
+        state["modes"] = dict(modes)
+
+        by_label = (
+            rows.filter(meta__mode="tutor_asks")
+            .annotate(
+                question=KeyTextTransform("main_question", "meta"),
+                label=KeyTextTransform("correctness", "meta"),
+            )
+            .values("question", "label")
+            .annotate(turns=Count("id"))
+        )
+        for row in by_label:
+            labels = state["labels"].setdefault(row["question"] or "unknown", {})
+            label = row["label"] or "unknown"
+            labels[label] = labels.get(label, 0) + row["turns"]
+
+    def track_mastery(self, rows, state, chunk_size):
+        """
+        Turns each participant needed on a question (of a topic) up to their
+        first 'correct'. Streams three small columns in id order. The checkpoint
+        keeps a turn count per pair still open and, so later turns on it are
+        skipped, the keys of mastered pairs: memory grows with the number of
+        (participant, question) pairs seen, not with the number of turns.
+        """
+        stream = (
+            rows.filter(meta__mode="tutor_asks")
+            .annotate(
+                topic=KeyTextTransform("topic", "meta"),
+                question=KeyTextTransform("main_question", "meta"),
+                label=KeyTextTransform("correctness", "meta"),
+            )
+            .order_by("id")
+            .values_list("user_id", "topic", "question", "label")
+            .iterator(chunk_size=chunk_size)
+        )
+        open_pairs = state["open"]
+        done = set(state["done"])
+        for user_id, topic, question, label in stream:
+            key = f"{user_id}|{topic}|{question}"
+            if key in done:
+                continue
+            turns = open_pairs.get(key, 0) + 1
+            if label == "correct":
+                dist = state["mastered"].setdefault(question or "unknown", {})
+                dist[str(turns)] = dist.get(str(turns), 0) + 1
+                open_pairs.pop(key, None)
+                done.add(key)
+            else:
+                open_pairs[key] = turns
+        state["done"] = sorted(done)
+
+    def build_report(self, state):
+        questions = {}
+        for question, labels in state["labels"].items():
+            total = sum(labels.values())
+            dist = state["mastered"].get(question, {})
+            mastered = sum(dist.values())
+            questions[question] = {
+                "turns": total,
+                "labels": labels,
+                "correct_rate": round(labels.get("correct", 0) / total, 3) if total else None,
+                "mastered": mastered,
+                "mean_turns_to_mastery": (
+                    round(sum(int(t) * n for t, n in dist.items()) / mastered, 2) if mastered else None
+                ),
+            }
+        return {
+            "last_id": state["last_id"],
+            "modes": state["modes"],
+            "questions": questions,
+        }
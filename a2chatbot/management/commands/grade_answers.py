@@ -0,0 +1,303 @@
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import openai
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.fields.json import KeyTextTransform
+
+from a2chatbot import admission, resilience
+from a2chatbot.grading import FALLBACK_THRESHOLDS, evaluate_correctness, label_from_similarity
+from a2chatbot.models import ChatLog
+from a2chatbot.prompts import CORRECTNESS_LABELS
+from a2chatbot.topics import get_topic
+from a2chatbot.vectorstore import embed_text
+
+OTHER = "other"
+MATRIX_LABELS = CORRECTNESS_LABELS + [OTHER]
+OVERLOADED_RETRIES = 5
+
+
+def normalize_label(label):
+    label = (label or "").strip().lower().strip(".'\"")
+    return label if label in CORRECTNESS_LABELS else OTHER
+
+
+class Command(BaseCommand):
+    help = (
+        "Grades recorded student answers against the topic's ground truth, "
+        "either with the OpenAI eval prompt (bounded concurrency) or the local "
+        "embedding-similarity grader, and prints confusion matrices against "
+        "human labels and the label recorded at the time. Results are appended "
+        "to --output, which is also the checkpoint: a rerun skips graded items."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--input", help="JSONL of answers. Default: tutor-mode turns from ChatLog.")
+        parser.add_argument("--labels", help="JSONL of human labels: {\"id\": ..., \"label\": ...}.")
+        parser.add_argument("--output", required=True, help="JSONL of grades (appended; used to resume).")
+        parser.add_argument("--grader", choices=["openai", "local"], default="openai")
+        parser.add_argument("--concurrency", type=int, default=8, help="OpenAI calls in flight at once.")
+        parser.add_argument("--batch-size", type=int, default=256, help="Answers embedded per call (local grader).")
+        parser.add_argument("--thresholds", default=",".join(str(t) for t in FALLBACK_THRESHOLDS),
+                            help="Local grader similarity thresholds: correct,partially correct.")
+        parser.add_argument("--limit", type=int, help="Grade at most this many new items.")
+        parser.add_argument("--report", help="Write the confusion matrices as JSON here.")
+
+    def handle(self, *args, **options):
+        try:
+            self.thresholds = tuple(float(t) for t in options["thresholds"].split(","))
+        except ValueError:
+            raise CommandError("--thresholds must be two numbers, e.g. 0.75,0.5")
+        if len(self.thresholds) != 2:
+            raise CommandError("--thresholds must be two numbers, e.g. 0.75,0.5")
+        if options["concurrency"] < 1:
+            raise CommandError("--concurrency must be at least 1")
+
+        human = self.load_labels(options["labels"]) if options["labels"] else {}
+        results = self.load_results(options["output"])
+        done = {r["id"] for r in results}
+        if done:
+            self.stderr.write(f"Resuming: {len(done)} items already graded")
+
+        items = (item for item in self.read_items(options["input"], human) if item["id"] not in done)
+        if options["limit"]:
+            items = (item for _, item in zip(range(options["limit"]), items))
+
+        start = time.monotonic()
+        grade = self.grade_local if options["grader"] == "local" else self.grade_openai
+        with open(options["output"], "a") as out:
+            graded = grade(items, out, results, options)
+        self.stderr.write(f"Graded {graded} items in {time.monotonic() - start:.1f}s")
+
+        report = {
+            "grader": options["grader"],
+            "items": len(results),
+            "vs_human": self.confusion(results, "human"),
+            "vs_recorded": self.confusion(results, "recorded"),
+        }
+        for name in ("vs_human", "vs_recorded"):
+            if report[name]:
+                self.stdout.write(self.format_matrix(name, report[name]))
+        if options["report"]:
+            with open(options["report"], "w") as f:
+                json.dump(report, f, indent=2)
+
+    # ---------- input ----------
+
+    def load_labels(self, path):
+        labels = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    labels[str(row["id"])] = row["label"]
+        return labels
+
+    def load_results(self, path):
+        results = []
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        results.append(json.loads(line))
+        return results
+
+    def read_items(self, path, human):
+        """
+        Yield {id, question, ground_truth, answer, human, recorded}, streaming
+        from the JSONL file or from ChatLog.
+        """
+        ground_truths = {}
+
+        def ground_truth_for(topic_name, question):
+            if topic_name not in ground_truths:
+                topic = get_topic(topic_name)
+                ground_truths[topic_name] = {q["question"]: q["answer"] for q in topic.qa}
+            return ground_truths[topic_name].get(question)
+
+        if path:
+            with open(path) as f:
+                for n, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    item_id = str(row.get("id", n))
+                    truth = row.get("ground_truth") or ground_truth_for(row.get("topic"), row.get("question"))
+                    if truth is None:
+                        self.stderr.write(f"Skipping {item_id}: no ground truth for {row.get('question')!r}")
+                        continue
+                    yield {
+                        "id": item_id,
+                        "question": row.get("question"),
+                        "ground_truth": truth,
+                        "answer": row["answer"],
+                        "human": human.get(item_id, row.get("human_label") or row.get("label")),
+                        "recorded": row.get("correctness"),
+                    }
+            return
+
+        rows = (
+            ChatLog.objects.filter(meta__mode="tutor_asks")
+            .annotate(
+                topic=KeyTextTransform("topic", "meta"),
+                question=KeyTextTransform("main_question", "meta"),
+                recorded=KeyTextTransform("correctness", "meta"),
+                human_label=KeyTextTransform("human_label", "meta"),
+            )
+            .order_by("id")
+            .values_list("id", "topic", "question", "message", "recorded", "human_label")
+            .iterator(chunk_size=2000)
+        )
+        for row_id, topic_name, question, message, recorded, human_label in rows:
+            truth = ground_truth_for(topic_name, question)
+            if truth is None:
+                continue
+            yield {
+                "id": str(row_id),
+                "question": question,
+                "ground_truth": truth,
+                "answer": message,
+                "human": human.get(str(row_id), human_label),
+                "recorded": recorded,
+            }
+
+    # ---------- grading ----------
+
+    def write(self, out, results, item, label):
+        result = {
+            "id": item["id"],
+            "question": item["question"],
+            "label": normalize_label(label),
+            "raw_label": label,
+            "human": item["human"],
+            "recorded": item["recorded"],
+        }
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        results.append(result)
+
+    def grade_openai(self, items, out, results, options):
+        """
+        Grade with the production eval prompt, keeping at most `concurrency`
+        calls in flight. Items that fail are left out and graded next run.
+        """
+        # No hedging (throughput, not tail latency, matters here) and a
+        # breaker of our own, so batch failures never trip the one serving
+        # turns; while it is open, items are left for the next run
+        circuit = resilience.CircuitBreaker(
+            threshold=getattr(settings, "OPENAI_BREAKER_THRESHOLD", 5),
+            cooldown=getattr(settings, "OPENAI_BREAKER_COOLDOWN", 30.0),
+        )
+
+        def grade(item):
+            for _ in range(OVERLOADED_RETRIES):
+                try:
+                    return evaluate_correctness(
+                        item["ground_truth"], item["answer"], hedge_after=None, circuit=circuit
+                    )
+                except admission.Overloaded as e:
+                    time.sleep(e.retry_after)
+            raise admission.Overloaded(1)
+
+        graded = failed = 0
+        concurrency = options["concurrency"]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            running = {}
+            for item in items:
+                running[pool.submit(grade, item)] = item
+                if len(running) < concurrency * 2:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    ok = self.collect(future, running.pop(future), out, results)
+                    graded, failed = graded + ok, failed + (not ok)
+            for future in list(running):
+                ok = self.collect(future, running.pop(future), out, results)
+                graded, failed = graded + ok, failed + (not ok)
+        if failed:
+            self.stderr.write(f"{failed} items failed; rerun to retry them")
+        return graded
+
+    def collect(self, future, item, out, results):
+        try:
+            label = future.result()
+        except (resilience.Unavailable, admission.Overloaded, openai.OpenAIError) as e:
+            # e.g. a non-retryable 4xx: leave the item for the next run
+            self.stderr.write(f"Item {item['id']} not graded: {e}")
+            return False
+        self.write(out, results, item, label)
+        return True
+
+    def grade_local(self, items, out, results, options):
+        """
+        Embedding-similarity grader (the fallback used when OpenAI is down),
+        embedding a whole batch of answers and ground truths per call.
+        """
+        graded = 0
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= options["batch_size"]:
+                graded += self.grade_local_batch(batch, out, results)
+                batch = []
+        if batch:
+            graded += self.grade_local_batch(batch, out, results)
+        return graded
+
+    def grade_local_batch(self, batch, out, results):
+        vectors = np.asarray(
+            embed_text([i["ground_truth"] for i in batch] + [i["answer"] for i in batch]), dtype=np.float32
+        )
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-9
+        truths, answers = vectors[: len(batch)], vectors[len(batch):]
+        similarities = (truths * answers).sum(axis=1)
+        for item, similarity in zip(batch, similarities):
+            self.write(out, results, item, label_from_similarity(item["answer"], float(similarity), self.thresholds))
+        return len(batch)
+
+    # ---------- report ----------
+
+    def confusion(self, results, reference):
+        """
+        Counts of (reference label -> grader label), plus accuracy and
+        per-label precision/recall. Empty if no item has a reference label.
+        """
+        pairs = Counter(
+            (normalize_label(r[reference]), r["label"]) for r in results if r.get(reference)
+        )
+        total = sum(pairs.values())
+        if not total:
+            return {}
+        matrix = {truth: {label: pairs[(truth, label)] for label in MATRIX_LABELS} for truth in MATRIX_LABELS}
+        per_label = {}
+        for label in CORRECTNESS_LABELS:
+            predicted = sum(matrix[t][label] for t in MATRIX_LABELS)
+            actual = sum(matrix[label].values())
+            hit = matrix[label][label]
+            per_label[label] = {
+                "precision": round(hit / predicted, 3) if predicted else None,
+                "recall": round(hit / actual, 3) if actual else None,
+            }
+        return {
+            "items": total,
+            # An unrecognised label never counts as agreement
+            "accuracy": round(sum(matrix[l][l] for l in CORRECTNESS_LABELS) / total, 3),
+            "matrix": matrix,
+            "per_label": per_label,
+        }
+
+    def format_matrix(self, name, result):
+        width = max(len(l) for l in MATRIX_LABELS) + 2
+        lines = [
+            f"\n{name}: {result['items']} items, accuracy {result['accuracy']}",
+            "reference \\ grader".ljust(width) + "".join(l.rjust(width) for l in MATRIX_LABELS),
+        ]
+        for truth in MATRIX_LABELS:
+            row = result["matrix"][truth]
+            lines.append(truth.ljust(width) + "".join(str(row[l]).rjust(width) for l in MATRIX_LABELS))
+        return "\n".join(lines)
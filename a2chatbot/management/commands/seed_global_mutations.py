@@ -1,13 +1,33 @@
-from django.core.management.base import BaseCommand
-from a2chatbot.vectorstore import get_collection, embed_text, chunk_text
+from django.core.management.base import BaseCommand, CommandError
+from a2chatbot import artifacts
+from a2chatbot.vectorstore import embed_text, chunk_text
+from a2chatbot.topics import DEFAULT_TOPIC, UnknownTopic, registry
 
 class Command(BaseCommand):
-    help = "Seeds mutation transcript into global vector store"
+    help = "Seeds a topic's transcript (seed_data/<topic>.txt) into its global vector store"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--topic", default=DEFAULT_TOPIC)
+        parser.add_argument("--artifacts-only", action="store_true",
+                            help="Only rebuild the precomputed per-question artifacts.")
 
     def handle(self, *args, **options):
-        coll = get_collection("global_mutation")
+        try:
+            topic = registry.get(options["topic"])
+        except UnknownTopic:
+            raise CommandError(f"No QA set for topic '{options['topic']}' in a2chatbot/data/")
+        if not options["artifacts_only"]:
+            self.seed(topic)
+
+        artifacts.build(topic)
+        self.stdout.write(self.style.SUCCESS(
+            f"Question artifacts for {topic.name} written to {artifacts.artifacts_dir()}"
+        ))
+
+    def seed(self, topic):
+        coll = topic.collection()
 
-        with open("a2chatbot/seed_data/mutation.txt", "r") as f:
+        with open(f"a2chatbot/seed_data/{topic.name}.txt", "r") as f:
             text = f.read()
 
         chunks = chunk_text(text, chunk_size=300)
@@ -17,4 +37,4 @@ class Command(BaseCommand):
         # add to chroma
         coll.add(documents=chunks, embeddings=embeddings, ids=ids)
 
-        self.stdout.write(self.style.SUCCESS("Global mutation knowledge seeded into Chroma"))
+        self.stdout.write(self.style.SUCCESS(f"Global {topic.subject} knowledge seeded into Chroma ({topic.collection_name})"))
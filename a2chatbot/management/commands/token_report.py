@@ -0,0 +1,127 @@
+import json
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from a2chatbot.models import ChatLog, TokenUsage
+
+DEFAULT_PRICES = {"prompt": 0.15, "cached": 0.075, "completion": 0.60}
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports OpenAI token spend and estimated cost per pipeline stage "
+        "(persona, eval, run, ...) and the heaviest users, from the daily "
+        "TokenUsage totals. --by-path also splits it by mode and tutor turn path."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=7, help="Days to cover, including today.")
+        parser.add_argument("--user", help="Only this username.")
+        parser.add_argument("--top", type=int, default=10, help="Heaviest users to list.")
+        parser.add_argument("--by-path", action="store_true",
+                            help="Also attribute spend to mode/turn path from ChatLog.meta (streams ChatLog).")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options["days"] < 1:
+            raise CommandError("--days must be at least 1")
+        since = timezone.localdate() - timedelta(days=options["days"] - 1)
+        self.prices = getattr(settings, "OPENAI_PRICE_PER_MTOK", DEFAULT_PRICES)
+
+        rows = TokenUsage.objects.filter(day__gte=since)
+        logs = ChatLog.objects.filter(timestamp__date__gte=since)
+        if options["user"]:
+            rows = rows.filter(user__username=options["user"])
+            logs = logs.filter(user__username=options["user"])
+
+        report = {
+            "since": since.isoformat(),
+            "stages": self.by_stage(rows),
+            "top_users": self.top_users(rows, options["top"]),
+        }
+        if options["by_path"]:
+            report["paths"] = self.by_path(logs, options["chunk_size"])
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def cost(self, prompt, cached, completion):
+        """
+        USD for the tokens, with the cached part of the prompt at the cached rate.
+        """
+        cached_price = self.prices.get("cached", self.prices["prompt"])
+        return round(
+            ((prompt - cached) * self.prices["prompt"] + cached * cached_price
+             + completion * self.prices["completion"]) / 1e6,
+            4,
+        )
+
+    def by_stage(self, rows):
+        totals = (
+            rows.values("stage")
+            .annotate(
+                calls=Sum("calls"),
+                prompt=Sum("prompt_tokens"),
+                cached=Sum("cached_tokens"),
+                completion=Sum("completion_tokens"),
+            )
+            .order_by("stage")
+        )
+        grand = sum(r["prompt"] + r["completion"] for r in totals) or 1
+        return {
+            r["stage"]: {
+                "calls": r["calls"],
+                "prompt_tokens": r["prompt"],
+                "cached_tokens": r["cached"],
+                "completion_tokens": r["completion"],
+                "share": round((r["prompt"] + r["completion"]) / grand, 3),
+                "cost_usd": self.cost(r["prompt"], r["cached"], r["completion"]),
+            }
+            for r in totals
+        }
+
+    def top_users(self, rows, limit):
+        totals = (
+            rows.values("user__username")
+            .annotate(
+                prompt=Sum("prompt_tokens"),
+                cached=Sum("cached_tokens"),
+                completion=Sum("completion_tokens"),
+                total=Sum(F("prompt_tokens") + F("completion_tokens")),
+            )
+            .order_by("-total")[:limit]
+        )
+        return [
+            {
+                "user": r["user__username"],
+                "prompt_tokens": r["prompt"],
+                "cached_tokens": r["cached"],
+                "completion_tokens": r["completion"],
+                "cost_usd": self.cost(r["prompt"], r["cached"], r["completion"]),
+            }
+            for r in totals
+        ]
+
+    def by_path(self, logs, chunk_size):
+        """
+        Tokens per (mode, turn path, stage), from the usage stored on each turn.
+        """
+        paths = defaultdict(lambda: defaultdict(lambda: {"turns": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}))
+        for meta in logs.order_by("id").values_list("meta", flat=True).iterator(chunk_size=chunk_size):
+            if not meta or not meta.get("usage"):
+                continue
+            path = meta.get("mode", "unknown")
+            if meta.get("turn_path"):
+                path += "/" + meta["turn_path"]
+            if meta.get("budget"):
+                path += f" (budget {meta['budget']})"
+            for stage, used in meta["usage"].items():
+                entry = paths[path][stage]
+                entry["turns"] += 1
+                entry["prompt_tokens"] += used.get("prompt", 0)
+                entry["cached_tokens"] += used.get("cached", 0)
+                entry["completion_tokens"] += used.get("completion", 0)
+        return {path: dict(stages) for path, stages in sorted(paths.items())}
@@ -0,0 +1,305 @@
+"""
+Lightweight in-process metrics for the tutoring pipeline.
+
+Each stage of a turn (embedding, Chroma query, OpenAI calls, ChatLog insert)
+is timed with `span(...)`. Observations go into Prometheus-style histograms
+that the /metrics view renders as text, and, while a view wrapped with
+`timed_view` is running, into a per-request timings dict that can be stored
+in ChatLog.meta.
+
+Metrics live in each process's memory. When several worker processes serve
+the app, set METRICS_MULTIPROC_DIR to a directory shared by them: every
+process then writes a snapshot there every few seconds, and /metrics returns
+counters and histograms summed over all processes (including exited ones)
+and gauges over the live ones only, instead of whichever worker happened
+to answer the scrape.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. OpenAI runs routinely take several seconds, so the upper buckets
+# are wider than the Prometheus client defaults.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+# Seconds between snapshots in multiprocess mode
+SNAPSHOT_INTERVAL = 5.0
+
+_lock = threading.Lock()
+# A context variable rather than a thread-local, so that work handed to other
+# threads with contextvars.copy_context() (hedged calls) still reports here.
+_timings = contextvars.ContextVar("a2chatbot_timings", default=None)
+_registry = []
+_snapshot_pid = None
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count above last bucket, sum]
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        i = bisect_left(self.buckets, value)
+        with _lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with _lock:
+            return {k: list(v) for k, v in self._series.items()}
+
+    @staticmethod
+    def merge(total, values):
+        if total is None:
+            return list(values)
+        return [a + b for a, b in zip(total, values)]
+
+    def render(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labelvalues, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            labels = _format_labels(self.labelnames, labelvalues, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, *labelvalues):
+        with _lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def snapshot(self):
+        with _lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, value):
+        return value if total is None else total + value
+
+    def render(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """
+    `multiprocess_mode` says how live workers' values are combined: "sum"
+    (e.g. queue depth) or "max" (e.g. a 0/1 flag).
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), multiprocess_mode="sum"):
+        super().__init__(name, help_text, labelnames)
+        self.multiprocess_mode = multiprocess_mode
+
+    def merge(self, total, value):
+        if total is None:
+            return value
+        return max(total, value) if self.multiprocess_mode == "max" else total + value
+
+    def set(self, value, *labelvalues):
+        with _lock:
+            self._values[labelvalues] = value
+
+
+STAGE_SECONDS = Histogram(
+    "a2chatbot_stage_seconds",
+    "Time spent in each stage of a request.",
+    ("stage",),
+)
+VIEW_SECONDS = Histogram(
+    "a2chatbot_view_seconds",
+    "End-to-end time spent in each view.",
+    ("view",),
+)
+
+
+@contextmanager
+def span(stage):
+    """
+    Time a block of work under the given stage name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage)
+        timings = _timings.get()
+        if timings is not None:
+            with _lock:
+                timings[stage] = round(timings.get(stage, 0.0) + elapsed * 1000, 1)
+
+
+def timed_view(name):
+    """
+    Decorator that times a whole view and collects the spans it opens.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            _start_snapshots()
+            token = _timings.set({})
+            start = time.perf_counter()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                VIEW_SECONDS.observe(time.perf_counter() - start, name)
+                _timings.reset(token)
+        return wrapper
+    return decorator
+
+
+def request_timings():
+    """
+    Milliseconds per stage recorded so far in the current request.
+    """
+    timings = _timings.get()
+    if timings is None:
+        return {}
+    with _lock:
+        return dict(timings)
+
+
+# ---------- Multiprocess mode ----------
+
+def multiproc_dir():
+    return getattr(settings, "METRICS_MULTIPROC_DIR", None)
+
+
+def write_snapshot():
+    """
+    Write this process's metrics to <METRICS_MULTIPROC_DIR>/<pid>.json.
+    """
+    directory = multiproc_dir()
+    if not directory:
+        return
+    data = {
+        metric.name: [[list(labels), values] for labels, values in metric.snapshot().items()]
+        for metric in _registry
+    }
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def _snapshot_loop():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except OSError as e:
+            print("[WARN] Could not write metrics snapshot:", e)
+
+
+def _start_snapshots():
+    """
+    Start this process's snapshot thread (once per process, after any fork).
+    """
+    global _snapshot_pid
+    if _snapshot_pid == os.getpid() or not multiproc_dir():
+        return
+    with _lock:
+        if _snapshot_pid == os.getpid():
+            return
+        _snapshot_pid = os.getpid()
+    os.makedirs(multiproc_dir(), exist_ok=True)
+    threading.Thread(target=_snapshot_loop, name="metrics-snapshot", daemon=True).start()
+
+
+def _merged_snapshots():
+    """
+    {metric name: {label values: merged value}} over all processes' snapshots.
+    Files of exited workers are kept, so counters never go backwards, but
+    their gauges are ignored: they describe a process that is gone.
+    """
+    directory = multiproc_dir()
+    kinds = {metric.name: metric for metric in _registry}
+    merged = {name: {} for name in kinds}
+    for filename in os.listdir(directory):
+        if not filename.endswith(".json"):
+            continue
+        live = _pid_alive(filename[: -len(".json")])
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, series in data.items():
+            if name not in kinds or (isinstance(kinds[name], Gauge) and not live):
+                continue
+            for labels, values in series:
+                key = tuple(labels)
+                merged[name][key] = kinds[name].merge(merged[name].get(key), values)
+    return merged
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render():
+    merged = None
+    if multiproc_dir():
+        write_snapshot()
+        merged = _merged_snapshots()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render(merged[metric.name] if merged is not None else None))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a2chatbot', '0002_chatlog'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatlog',
+            index=models.Index(fields=['user', 'timestamp', 'id'], name='chatlog_user_ts_id_idx'),
+        ),
+    ]
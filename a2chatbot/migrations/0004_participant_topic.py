@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a2chatbot', '0003_chatlog_user_ts_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='topic',
+            field=models.CharField(default='mutation', max_length=50),
+        ),
+    ]
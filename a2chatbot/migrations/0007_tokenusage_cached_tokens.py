@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a2chatbot', '0006_tokenusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tokenusage',
+            name='cached_tokens',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -30,6 +30,10 @@ class Participant(models.Model):
     )
     updated_at = models.DateTimeField(auto_now=True, blank=True)
     mode = models.CharField(max_length=20, default="tutor_asks")
+    topic = models.CharField(max_length=50, default="mutation")
+    # lease held while a turn is running (see a2chatbot/turns.py)
+    turn_lease_token = models.CharField(max_length=32, blank=True, null=True)
+    turn_lease_until = models.DateTimeField(blank=True, null=True)
 
 
     def __unicode__(self):
@@ -60,5 +64,58 @@ class ChatLog(models.Model):
     meta = models.JSONField(default=dict, blank=True, null=True)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # newest-first history per user (keyset pagination)
+            models.Index(fields=["user", "timestamp", "id"], name="chatlog_user_ts_id_idx"),
+        ]
+
     def __str__(self):
         return f"{self.user.username} @ {self.timestamp}"
+
+
+class TurnRequest(models.Model):
+    """
+    One sendmessage call identified by a client-supplied idempotency key,
+    so a retried request gets the original reply instead of a second run.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+    ]
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, default="pending", choices=STATUS_CHOICES)
+    response = models.JSONField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "key"], name="turnrequest_user_key_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} {self.key} ({self.status})"
+
+
+class TokenUsage(models.Model):
+    """
+    OpenAI tokens used by one user on one day, per pipeline stage
+    (persona, eval, run, ...). Used for daily budgets and cost reports.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    day = models.DateField()
+    stage = models.CharField(max_length=40)
+    calls = models.IntegerField(default=0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    # Part of prompt_tokens served from OpenAI's prompt prefix cache
+    cached_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "day", "stage"], name="tokenusage_user_day_stage_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} {self.day} {self.stage}"
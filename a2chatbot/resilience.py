@@ -0,0 +1,366 @@
+"""
+Resilient wrapper for OpenAI calls.
+
+`call(stage, attempt)` runs one logical API call with:
+- a per-stage deadline (OPENAI_STAGE_DEADLINES), passed to the client as the
+  request timeout of every attempt;
+- jittered exponential-backoff retries on errors worth retrying;
+- optional hedging: if the first attempt's request is slow, a second one
+  is started and used if the first one fails;
+- a circuit breaker shared by all stages (unless the caller brings its
+  own), so that when OpenAI is unhealthy
+  callers get `CircuitOpen` at once and can fall back to a local answer.
+
+Anything that means "upstream could not answer in time" (including an
+assistant run that ended failed, expired or incomplete) is raised as
+`Unavailable` (or a subclass); other API errors propagate unchanged.
+"""
+
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from django.conf import settings
+
+from a2chatbot import admission, metrics
+
+RETRIES = metrics.Counter(
+    "a2chatbot_openai_retries_total",
+    "OpenAI call attempts that were retried.",
+    ("stage",),
+)
+HEDGES = metrics.Counter(
+    "a2chatbot_openai_hedges_total",
+    "Hedged second attempts started for slow OpenAI calls.",
+    ("stage",),
+)
+HEDGES_SKIPPED = metrics.Counter(
+    "a2chatbot_openai_hedges_skipped_total",
+    "Hedges not started because every hedge worker was busy.",
+    ("stage",),
+)
+UNAVAILABLE = metrics.Counter(
+    "a2chatbot_openai_unavailable_total",
+    "OpenAI calls that gave up (deadline, retries exhausted or circuit open).",
+    ("stage", "reason"),
+)
+POLL_ERRORS = metrics.Counter(
+    "a2chatbot_openai_run_poll_errors_total",
+    "Transient errors while polling an assistant run (the poll is retried).",
+)
+CIRCUIT_OPEN = metrics.Gauge(
+    "a2chatbot_openai_circuit_open",
+    "1 while the OpenAI circuit breaker is open (in any worker).",
+    multiprocess_mode="max",
+)
+
+RUN_ACTIVE_STATUSES = ("queued", "in_progress", "cancelling")
+RUN_RETRYABLE_ERRORS = ("server_error", "rate_limit_exceeded")
+TRANSIENT_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+# Run polling: start at POLL_INTERVAL and back off to MAX_POLL_INTERVAL,
+# unless the server says when to poll next (openai-poll-after-ms).
+POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 5.0
+
+HEDGE_WORKERS = 8
+
+# Only hedges run here; first attempts run in the caller's thread. A hedge
+# is only started when a worker is free, so it never waits in the pool.
+_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="openai-hedge")
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+# Set by an attempt once it is admitted and sends its request
+_sent = contextvars.ContextVar("a2chatbot_openai_sent", default=None)
+
+
+class Unavailable(Exception):
+    pass
+
+
+class DeadlineExceeded(Unavailable):
+    pass
+
+
+class AdmissionDeadlineExceeded(DeadlineExceeded):
+    """
+    The deadline ran out while waiting for admission, before anything was
+    sent, so it says nothing about OpenAI's health.
+    """
+
+
+class CircuitOpen(Unavailable):
+    pass
+
+
+class RunFailed(Exception):
+    def __init__(self, run):
+        self.status = run.status
+        self.code = run.last_error.code if run.last_error else None
+        super().__init__(f"Run {run.id} ended with status {self.status} ({self.code})")
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. After `cooldown` seconds a
+    single trial call is let through; its outcome closes or re-opens it.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_running or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+        CIRCUIT_OPEN.set(0)
+
+    def release_trial(self):
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+                CIRCUIT_OPEN.set(1)
+
+
+breaker = CircuitBreaker(
+    threshold=getattr(settings, "OPENAI_BREAKER_THRESHOLD", 5),
+    cooldown=getattr(settings, "OPENAI_BREAKER_COOLDOWN", 30.0),
+)
+
+
+def stage_deadline(stage):
+    deadlines = getattr(settings, "OPENAI_STAGE_DEADLINES", {})
+    return deadlines.get(stage, deadlines.get("default", 30.0))
+
+
+def is_retryable(exc):
+    if isinstance(exc, RunFailed):
+        return exc.code in RUN_RETRYABLE_ERRORS
+    return isinstance(exc, TRANSIENT_ERRORS)
+
+
+def call(stage, attempt, hedge_after=None, circuit=None):
+    """
+    Run `attempt(timeout)` under the stage's deadline, retry and breaker policy.
+    `circuit` replaces the shared breaker, e.g. for batch jobs whose failures
+    should not make serving fall back.
+    """
+    circuit = circuit or breaker
+    deadline = time.monotonic() + stage_deadline(stage)
+    max_retries = getattr(settings, "OPENAI_MAX_RETRIES", 2)
+
+    for retry in range(max_retries + 1):
+        if not circuit.allow():
+            UNAVAILABLE.inc(1, stage, "circuit_open")
+            raise CircuitOpen(f"OpenAI circuit open, skipping {stage}")
+
+        remaining = deadline - time.monotonic()
+        try:
+            if hedge_after is not None and hedge_after < remaining:
+                result = _hedged(stage, attempt, remaining, hedge_after)
+            else:
+                result = attempt(remaining)
+        except AdmissionDeadlineExceeded:
+            circuit.release_trial()
+            UNAVAILABLE.inc(1, stage, "admission_deadline")
+            raise
+        except Unavailable as e:
+            circuit.record_failure()
+            UNAVAILABLE.inc(1, stage, "deadline" if isinstance(e, DeadlineExceeded) else "run_failed")
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                # Says nothing about upstream health (bad request, local
+                # admission control), so just let the next trial through.
+                circuit.release_trial()
+                raise
+            circuit.record_failure()
+            backoff = random.uniform(0, min(8.0, 0.5 * 2 ** retry))
+            if retry == max_retries or time.monotonic() + backoff >= deadline:
+                UNAVAILABLE.inc(1, stage, "retries_exhausted")
+                raise Unavailable(f"{stage} failed after {retry + 1} attempt(s)") from e
+            RETRIES.inc(1, stage)
+            time.sleep(backoff)
+            continue
+
+        circuit.record_success()
+        return result
+
+
+def request_sent():
+    """
+    Called by an attempt once it has been admitted and is about to send its
+    request. The hedge delay counts from here, so time spent queued locally
+    never starts a hedge.
+    """
+    event = _sent.get()
+    if event is not None:
+        event.set()
+
+
+def _hedged(stage, attempt, timeout, hedge_after):
+    """
+    Run `attempt` in the caller's thread. If its request has been in flight
+    for `hedge_after` seconds and a hedge worker is free, a second attempt
+    starts on the executor; its answer is used if the first attempt fails.
+    """
+    deadline = time.monotonic() + timeout
+    # The hedge runs in a copy of the caller's context, so its spans and
+    # usage still count towards the request
+    context = contextvars.copy_context()
+    sent, finished = threading.Event(), threading.Event()
+    hedge = []
+
+    def run_hedge(slots):
+        try:
+            return attempt(deadline - time.monotonic())
+        finally:
+            slots.release()
+
+    def watch():
+        if not sent.wait(timeout) or finished.wait(hedge_after):
+            return
+        slots = _hedge_slots
+        if not slots.acquire(blocking=False):
+            HEDGES_SKIPPED.inc(1, stage)
+            return
+        HEDGES.inc(1, stage)
+        hedge.append(_executor.submit(context.run, run_hedge, slots))
+
+    watcher = threading.Thread(target=watch, name="openai-hedge-timer", daemon=True)
+    token = _sent.set(sent)
+    watcher.start()
+    try:
+        return attempt(timeout)
+    except Exception:
+        finished.set()
+        sent.set()
+        watcher.join()
+        if not hedge:
+            raise
+        try:
+            return hedge[0].result(timeout=max(0, deadline - time.monotonic()))
+        except Exception:
+            pass
+        raise
+    finally:
+        finished.set()
+        sent.set()
+        _sent.reset(token)
+
+
+def create_and_poll(runs, timeout, admit=None, poll_interval=POLL_INTERVAL, **kwargs):
+    """
+    Like runs.create_and_poll, but gives up (and cancels the run) once
+    `timeout` seconds have passed instead of polling indefinitely.
+
+    If creating the run times out, or fails because the thread already has
+    an active run, that run is polled instead of starting another one.
+    Each poll first calls `admit()` (if given) so it counts against the
+    request quota. A poll that fails transiently is retried until the
+    deadline: the run is still going, and retrying the whole attempt would
+    try to start a second run on the thread. The run is cancelled whenever
+    we stop waiting for it. A run that ends in any state other than
+    completed raises RunFailed if it is worth retrying, Unavailable otherwise.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        run = runs.create(timeout=timeout, **kwargs)
+    except (openai.APIConnectionError, openai.BadRequestError):
+        # A timed-out create may still have started the run, and a retry then
+        # gets 400 "already has an active run": poll that run instead
+        run = _active_run(runs, kwargs["thread_id"], deadline - time.monotonic())
+        if run is None:
+            raise
+    interval = poll_interval
+    try:
+        while run.status in RUN_ACTIVE_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"Run {run.id} still {run.status} at its deadline")
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, MAX_POLL_INTERVAL)
+            try:
+                if admit is not None:
+                    admit()
+                run, poll_after = _retrieve(runs, run, max(1.0, deadline - time.monotonic()))
+            except admission.Overloaded as e:
+                interval = e.retry_after
+                continue
+            except TRANSIENT_ERRORS:
+                POLL_ERRORS.inc()
+                continue
+            if poll_after is not None:
+                interval = poll_after
+    except BaseException:
+        _cancel(runs, run)
+        raise
+
+    if run.status != "completed":
+        failure = RunFailed(run)
+        if is_retryable(failure):
+            raise failure
+        raise Unavailable(str(failure)) from failure
+    return run
+
+
+def _retrieve(runs, run, timeout):
+    """
+    Fetch the run's current state. Returns (run, seconds until the server
+    wants the next poll, or None).
+    """
+    response = runs.with_raw_response.retrieve(run_id=run.id, thread_id=run.thread_id, timeout=timeout)
+    poll_after = response.headers.get("openai-poll-after-ms")
+    return response.parse(), int(poll_after) / 1000 if poll_after else None
+
+
+def _active_run(runs, thread_id, timeout):
+    """
+    The thread's newest run if it is still active, else None.
+    """
+    if timeout <= 0:
+        return None
+    try:
+        page = runs.list(thread_id=thread_id, order="desc", limit=1, timeout=timeout)
+    except openai.OpenAIError:
+        return None
+    for run in page.data:
+        if run.status in RUN_ACTIVE_STATUSES:
+            return run
+    return None
+
+
+def _cancel(runs, run):
+    if run.status not in RUN_ACTIVE_STATUSES:
+        return
+    try:
+        runs.cancel(run_id=run.id, thread_id=run.thread_id, timeout=5)
+    except openai.OpenAIError:
+        pass
@@ -78,6 +78,9 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # The test database is created from the models: the migration
+        # history predates several Participant/ChatLog fields
+        "TEST": {"MIGRATE": False},
     }
 }
 
@@ -115,6 +118,82 @@ USE_TZ = True
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'home'
 
+# Store per-stage timings (ms) in ChatLog.meta["timings"] for every turn.
+CHATLOG_TIMINGS = True
+
+# With several worker processes, a directory shared by them: each process
+# writes its metrics there and /metrics returns the sum over all of them.
+# Clear it when deploying. None = per-process metrics.
+METRICS_MULTIPROC_DIR = None
+
+# OpenAI admission control (see a2chatbot/admission.py). The quotas are for
+# the whole account and are split evenly across worker processes.
+OPENAI_RPM = 500
+OPENAI_TPM = 200000
+OPENAI_WORKER_PROCESSES = 1
+OPENAI_MAX_QUEUE = 50      # calls allowed to wait at once
+OPENAI_MAX_WAIT = 10.0     # seconds a call may wait before failing fast
+
+# OpenAI resilience (see a2chatbot/resilience.py). Deadlines are in seconds
+# and cover all retries of one call, including the admission wait.
+OPENAI_STAGE_DEADLINES = {
+    "eval": 8.0,
+    "persona": 20.0,
+    "run": 90.0,
+    "default": 15.0,
+}
+OPENAI_MAX_RETRIES = 2
+OPENAI_HEDGE_EVAL_AFTER = 2.0    # start a second eval call if the first is this slow; None = off
+OPENAI_BREAKER_THRESHOLD = 5     # consecutive failures before falling back locally
+OPENAI_BREAKER_COOLDOWN = 30.0   # seconds before a trial call is let through again
+
+# Tutor-asks turns: get the correctness label and the reply from one
+# structured (JSON) assistant run instead of a separate eval call first.
+# Falls back to the two-call path when the output doesn't validate.
+TUTOR_COMBINED_TURN = True
+
+# Retrieved transcript chunks are cut down to the sentences most relevant to
+# the student's message (MMR selection, see a2chatbot/compression.py) within
+# this many (estimated) tokens before they go into the prompt.
+RAG_COMPRESSION = True
+RAG_TOKEN_BUDGET = 300
+RAG_MMR_LAMBDA = 0.7    # 1.0 = pure relevance, lower = more diversity
+# Tutor mode: transcript chunks precomputed for the current question (see
+# a2chatbot/artifacts.py) blended into the retrieval for the student's message.
+RAG_QUESTION_CHUNKS = 2
+# Seconds before a topic without (current) artifacts looks for them again.
+QUESTION_ARTIFACTS_RETRY = 60.0
+
+# Chroma store holding the global_<topic> transcript collections
+CHROMA_PATH = "./chromadb_storage"
+
+# Course units (see a2chatbot/topics.py): data/<topic>_qa.json + global_<topic>.
+DEFAULT_TOPIC = "mutation"
+TOPIC_CACHE_SIZE = 4    # topics kept loaded at once (least recently used is dropped)
+
+# Pre-created threads kept ready per question (see a2chatbot/warmpool.py).
+WARM_THREAD_POOL_SIZE = 1
+WARM_THREAD_TTL = 900.0      # seconds an untaken thread is kept before it is deleted
+WARM_THREAD_POOL_MAX = 50    # ready threads kept across all questions, per process
+
+# Per-participant turn lease and idempotency keys (see a2chatbot/turns.py).
+# The lease is renewed before every assistant run, so it must outlast the
+# longest stretch between renewals. None = derived from OPENAI_STAGE_DEADLINES
+# (one run plus the calls around it, about 3 minutes with the defaults).
+TURN_LEASE_SECONDS = None
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+# Daily OpenAI token budgets per user (see a2chatbot/usage.py). Over the soft
+# budget turns use a smaller RAG budget and cached answers; over the hard one
+# they get local fallback replies. None disables a limit.
+TOKEN_BUDGET_DAILY_SOFT = 60000
+TOKEN_BUDGET_DAILY_HARD = 150000
+RAG_TOKEN_BUDGET_REDUCED = 120
+
+# USD per million tokens, for `manage.py token_report` (gpt-4o-mini list price).
+# "cached" is the discounted rate for prompt tokens served from the cache.
+OPENAI_PRICE_PER_MTOK = {"prompt": 0.15, "cached": 0.075, "completion": 0.60}
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
@@ -0,0 +1,696 @@
+"""
+Fault-injection tests for the OpenAI resilience layer (a stub client that
+times out, returns 5xx/429 errors or answers slowly) and the degraded tutor
+and student turns built on top of it, plus admission control and turn
+coordination. No network needed; the Chroma store is pointed at a
+temporary directory.
+"""
+
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import openai
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.http import JsonResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from a2chatbot import admission, grading, llm, metrics, resilience, topics, turns, usage, vectorstore, views
+from a2chatbot.management.commands import grade_answers
+from a2chatbot.models import ChatLog, Participant, TokenUsage, TurnRequest
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/test")
+
+
+def setUpModule():
+    # Never open (or create) the real Chroma store
+    directory = tempfile.TemporaryDirectory()
+    unittest.addModuleCleanup(directory.cleanup)
+    chroma_path = override_settings(CHROMA_PATH=directory.name)
+    chroma_path.enable()
+    unittest.addModuleCleanup(chroma_path.disable)
+    chroma_client = mock.patch.object(vectorstore, "_chroma_client", None)
+    chroma_client.start()
+    unittest.addModuleCleanup(chroma_client.stop)
+
+
+def timeout_error():
+    return openai.APITimeoutError(request=REQUEST)
+
+
+def connection_error():
+    return openai.APIConnectionError(request=REQUEST)
+
+
+def status_error(cls, status):
+    return cls(f"HTTP {status}", response=httpx.Response(status, request=REQUEST), body=None)
+
+
+class StubCall:
+    """
+    Callable standing in for one OpenAI endpoint. Each call takes the next
+    scripted outcome: an exception is raised, anything else is returned, and
+    ("slow", seconds, outcome) sleeps first. The last outcome repeats.
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, timeout=None, **kwargs):
+        with self._lock:
+            self.calls.append(kwargs)
+            outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, tuple) and outcome[0] == "slow":
+            time.sleep(outcome[1])
+            outcome = outcome[2]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+def make_run(status, code=None):
+    last_error = SimpleNamespace(code=code) if code else None
+    return SimpleNamespace(id="run_1", thread_id="thread_1", status=status, last_error=last_error)
+
+
+class StubRuns:
+    """
+    client.beta.threads.runs: create() starts a queued run (or raises
+    `create_error`), list() shows `listed` runs, each retrieve() takes the
+    next scripted run state (or raises it), cancel() is recorded.
+    """
+
+    def __init__(self, *states, poll_after=None, create_error=None, listed=()):
+        self.retrieve = StubCall(*states)
+        self.create_calls = 0
+        self.create_error = create_error
+        self.listed = list(listed)
+        self.cancelled = []
+        self.poll_after = poll_after
+        self.with_raw_response = SimpleNamespace(retrieve=self._raw_retrieve)
+
+    def create(self, timeout=None, **kwargs):
+        self.create_calls += 1
+        if self.create_error is not None:
+            raise self.create_error
+        return make_run("queued")
+
+    def list(self, thread_id, order=None, limit=None, timeout=None):
+        return SimpleNamespace(data=self.listed[:limit])
+
+    def _raw_retrieve(self, run_id, thread_id, timeout=None):
+        run = self.retrieve(run_id=run_id, thread_id=thread_id)
+        headers = {"openai-poll-after-ms": str(self.poll_after)} if self.poll_after else {}
+        return SimpleNamespace(headers=headers, parse=lambda: run)
+
+    def cancel(self, run_id, thread_id, timeout=None):
+        self.cancelled.append(run_id)
+
+
+class ResilienceTestCase(SimpleTestCase):
+    def setUp(self):
+        # Fresh breaker per test, no real backoff sleeps, no admission waits
+        self.breaker = resilience.CircuitBreaker(threshold=3, cooldown=0.2)
+        self.backoffs = []
+        patches = [
+            mock.patch.object(resilience, "breaker", self.breaker),
+            mock.patch.object(resilience.random, "uniform", side_effect=self.record_backoff),
+            mock.patch.object(admission.governor, "acquire"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def record_backoff(self, low, high):
+        self.backoffs.append(high)
+        return 0
+
+
+@override_settings(OPENAI_MAX_RETRIES=2, OPENAI_STAGE_DEADLINES={"default": 5.0})
+class RetryTests(ResilienceTestCase):
+    def test_retries_transient_errors_with_backoff(self):
+        attempt = StubCall(
+            status_error(openai.InternalServerError, 500),
+            status_error(openai.RateLimitError, 429),
+            "ok",
+        )
+        self.assertEqual(resilience.call("eval", attempt), "ok")
+        self.assertEqual(len(attempt.calls), 3)
+        self.assertEqual(self.backoffs, [0.5, 1.0])
+
+    def test_gives_up_after_max_retries(self):
+        error = timeout_error()
+        attempt = StubCall(error)
+        with self.assertRaises(resilience.Unavailable) as cm:
+            resilience.call("eval", attempt)
+        self.assertIs(cm.exception.__cause__, error)
+        self.assertEqual(len(attempt.calls), 3)
+
+    def test_does_not_retry_client_errors(self):
+        attempt = StubCall(status_error(openai.BadRequestError, 400))
+        with self.assertRaises(openai.BadRequestError):
+            resilience.call("eval", attempt)
+        self.assertEqual(len(attempt.calls), 1)
+        self.assertEqual(self.breaker._failures, 0)
+
+    def test_passes_remaining_deadline_as_timeout(self):
+        timeouts = []
+        resilience.call("eval", lambda timeout: timeouts.append(timeout))
+        self.assertTrue(0 < timeouts[0] <= 5.0)
+
+    @override_settings(OPENAI_STAGE_DEADLINES={"default": 0.05})
+    def test_admission_wait_counts_against_deadline(self):
+        fn = StubCall("ok")
+        with mock.patch.object(admission.governor, "acquire", side_effect=lambda *a: time.sleep(0.1)):
+            with self.assertRaises(resilience.AdmissionDeadlineExceeded):
+                llm.openai_call("eval", fn)
+        self.assertEqual(fn.calls, [])
+        # Waiting for admission says nothing about OpenAI's health
+        self.assertEqual(self.breaker._failures, 0)
+
+
+@override_settings(OPENAI_MAX_RETRIES=0, OPENAI_STAGE_DEADLINES={"default": 5.0})
+class HedgingTests(ResilienceTestCase):
+    def sent_attempt(self, *outcomes):
+        """
+        A StubCall that reports its request as sent, like llm.openai_call.
+        """
+        call = StubCall(*outcomes)
+
+        def attempt(timeout):
+            resilience.request_sent()
+            return call(timeout=timeout)
+
+        attempt.calls = call.calls
+        return attempt
+
+    def test_hedge_answers_when_slow_first_attempt_fails(self):
+        attempt = self.sent_attempt(("slow", 0.3, timeout_error()), "second")
+        with mock.patch.object(resilience, "HEDGES") as hedges:
+            self.assertEqual(resilience.call("eval", attempt, hedge_after=0.05), "second")
+        hedges.inc.assert_called_once_with(1, "eval")
+        self.assertEqual(len(attempt.calls), 2)
+
+    def test_first_attempt_answers_even_if_hedged(self):
+        attempt = self.sent_attempt(("slow", 0.2, "first"), ("slow", 0.5, "second"))
+        self.assertEqual(resilience.call("eval", attempt, hedge_after=0.05), "first")
+
+    def test_first_attempt_runs_in_callers_thread(self):
+        threads = []
+
+        def attempt(timeout):
+            threads.append(threading.current_thread())
+            return "first"
+
+        resilience.call("eval", attempt, hedge_after=1.0)
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_fast_first_attempt_is_not_hedged(self):
+        attempt = self.sent_attempt("first")
+        self.assertEqual(resilience.call("eval", attempt, hedge_after=1.0), "first")
+        self.assertEqual(len(attempt.calls), 1)
+
+    def test_admission_wait_does_not_start_a_hedge(self):
+        fn = StubCall("ok")
+        with mock.patch.object(admission.governor, "acquire", side_effect=lambda *a: time.sleep(0.2)):
+            self.assertEqual(llm.openai_call("eval", fn, hedge_after=0.05), "ok")
+        self.assertEqual(len(fn.calls), 1)
+
+    def test_no_hedge_without_a_free_worker(self):
+        attempt = self.sent_attempt(("slow", 0.2, "first"))
+        with mock.patch.object(resilience, "_hedge_slots", threading.BoundedSemaphore(1)) as slots:
+            slots.acquire()
+            self.assertEqual(resilience.call("eval", attempt, hedge_after=0.05), "first")
+        self.assertEqual(len(attempt.calls), 1)
+
+    def test_concurrent_slow_calls_do_not_open_the_breaker(self):
+        attempt = self.sent_attempt(("slow", 0.15, "ok"))
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            results = list(pool.map(
+                lambda _: resilience.call("eval", attempt, hedge_after=0.2), range(32)
+            ))
+        self.assertEqual(results, ["ok"] * 32)
+        self.assertEqual(self.breaker._failures, 0)
+
+
+@override_settings(OPENAI_MAX_RETRIES=0, OPENAI_STAGE_DEADLINES={"default": 5.0})
+class CircuitBreakerTests(ResilienceTestCase):
+    def test_opens_then_trial_closes_it(self):
+        failing = StubCall(status_error(openai.InternalServerError, 503))
+        for _ in range(3):
+            with self.assertRaises(resilience.Unavailable):
+                resilience.call("eval", failing)
+
+        # Open: callers fail fast without reaching OpenAI
+        with self.assertRaises(resilience.CircuitOpen):
+            resilience.call("eval", failing)
+        self.assertEqual(len(failing.calls), 3)
+
+        # Half-open after the cooldown: a successful trial closes it
+        time.sleep(0.25)
+        self.assertEqual(resilience.call("eval", StubCall("ok")), "ok")
+        self.assertEqual(resilience.call("eval", StubCall("ok")), "ok")
+
+    def test_failed_trial_reopens_it(self):
+        failing = StubCall(timeout_error())
+        for _ in range(3):
+            with self.assertRaises(resilience.Unavailable):
+                resilience.call("eval", failing)
+        time.sleep(0.25)
+        with self.assertRaises(resilience.Unavailable):
+            resilience.call("eval", failing)
+        with self.assertRaises(resilience.CircuitOpen):
+            resilience.call("eval", StubCall("ok"))
+
+    def test_only_one_trial_at_a_time(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        time.sleep(0.25)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+
+
+class CreateAndPollTests(ResilienceTestCase):
+    def test_cancels_run_at_deadline(self):
+        runs = StubRuns(make_run("in_progress"))
+        with self.assertRaises(resilience.DeadlineExceeded):
+            resilience.create_and_poll(runs, timeout=0.1, poll_interval=0.01)
+        self.assertEqual(runs.cancelled, ["run_1"])
+
+    def test_poll_errors_do_not_start_a_second_run(self):
+        runs = StubRuns(connection_error(), timeout_error(), make_run("completed"))
+        run = resilience.create_and_poll(runs, timeout=5, poll_interval=0.01)
+        self.assertEqual(run.status, "completed")
+        self.assertEqual(runs.create_calls, 1)
+        self.assertEqual(runs.cancelled, [])
+
+    def test_charges_polls_to_admission(self):
+        admit = mock.Mock()
+        runs = StubRuns(make_run("in_progress"), make_run("completed"), poll_after=10)
+        resilience.create_and_poll(runs, timeout=5, admit=admit, poll_interval=0.01)
+        self.assertEqual(admit.call_count, 2)
+
+    def test_failed_run_without_retryable_code_is_unavailable(self):
+        for status in ("failed", "expired", "incomplete", "cancelled"):
+            runs = StubRuns(make_run(status))
+            with self.assertRaises(resilience.Unavailable) as cm:
+                resilience.create_and_poll(runs, timeout=5, poll_interval=0.01)
+            self.assertIsInstance(cm.exception.__cause__, resilience.RunFailed)
+
+    def test_create_timeout_polls_the_run_it_started(self):
+        runs = StubRuns(make_run("completed"), create_error=timeout_error(), listed=[make_run("in_progress")])
+        run = resilience.create_and_poll(runs, timeout=5, poll_interval=0.01, thread_id="thread_1")
+        self.assertEqual(run.status, "completed")
+        self.assertEqual(runs.create_calls, 1)
+
+    def test_active_run_conflict_polls_that_run(self):
+        conflict = status_error(openai.BadRequestError, 400)
+        runs = StubRuns(make_run("completed"), create_error=conflict, listed=[make_run("queued")])
+        run = resilience.create_and_poll(runs, timeout=5, poll_interval=0.01, thread_id="thread_1")
+        self.assertEqual(run.status, "completed")
+
+    def test_create_timeout_without_a_run_is_raised(self):
+        error = timeout_error()
+        runs = StubRuns(make_run("completed"), create_error=error, listed=[make_run("completed")])
+        with self.assertRaises(openai.APITimeoutError):
+            resilience.create_and_poll(runs, timeout=5, poll_interval=0.01, thread_id="thread_1")
+
+    def test_failed_run_with_server_error_is_retried(self):
+        runs = StubRuns(make_run("failed", code="server_error"))
+        with self.assertRaises(resilience.RunFailed):
+            resilience.create_and_poll(runs, timeout=5, poll_interval=0.01)
+
+
+@override_settings(
+    OPENAI_MAX_RETRIES=1,
+    OPENAI_STAGE_DEADLINES={"default": 1.0},
+    TUTOR_COMBINED_TURN=True,
+)
+class DegradedTurnTests(ResilienceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.logged = []
+        patches = [
+            mock.patch.object(views, "get_rag_context", return_value=("Mutations change DNA.", 5)),
+            mock.patch.object(views, "log_chat", side_effect=self.log_chat),
+            mock.patch.object(topics.Topic, "artifacts", return_value=None),
+            mock.patch.object(grading, "embed_text", return_value=[[1.0, 0.0], [1.0, 0.0]]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.request = SimpleNamespace(user=SimpleNamespace(username="student"))
+
+    def log_chat(self, user, studentmessage, reply, rag_context, meta):
+        self.logged.append(meta)
+
+    def participant(self, mode):
+        return SimpleNamespace(
+            topic=topics.DEFAULT_TOPIC,
+            mode=mode,
+            current_q_index=0,
+            assistant_id="asst_1",
+            current_thread_id="thread_1",
+            persona="",
+            turn_lease_token=None,
+        )
+
+    def test_tutor_turn_falls_back_when_openai_times_out(self):
+        messages = llm.client.beta.threads.messages
+        with mock.patch.object(messages, "create", StubCall(timeout_error())) as create:
+            response = views.handle_tutor_mode(self.request, self.participant("tutor_asks"), "It changes DNA")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(create.calls), 2)
+        meta = self.logged[0]
+        self.assertTrue(meta["degraded"])
+        # Labelled locally from embedding similarity
+        self.assertEqual(meta["correctness"], "correct")
+        self.assertIn("trouble reaching the tutor", response.content.decode())
+
+    def test_student_turn_falls_back_on_server_errors(self):
+        messages = llm.client.beta.threads.messages
+        error = status_error(openai.InternalServerError, 502)
+        with mock.patch.object(messages, "create", StubCall(error)):
+            response = views.handle_student_mode(self.request, self.participant("student_asks"), "What is a mutation?")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.logged[0]["degraded"])
+        self.assertIn("Mutations change DNA.", response.content.decode())
+
+    def test_turn_falls_back_on_non_retryable_errors(self):
+        messages = llm.client.beta.threads.messages
+        error = status_error(openai.BadRequestError, 400)
+        with mock.patch.object(messages, "create", StubCall(error)):
+            response = views.handle_tutor_mode(self.request, self.participant("tutor_asks"), "It changes DNA")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.logged[0]["degraded"])
+
+    def test_turn_falls_back_at_once_while_circuit_is_open(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        messages = llm.client.beta.threads.messages
+        with mock.patch.object(messages, "create", StubCall("unused")) as create:
+            response = views.handle_student_mode(self.request, self.participant("student_asks"), "What is a mutation?")
+        self.assertEqual(create.calls, [])
+        self.assertTrue(self.logged[0]["degraded"])
+        self.assertEqual(response.status_code, 200)
+
+
+class MultiprocessMetricsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, pid, data):
+        with open(os.path.join(self.directory, f"{pid}.json"), "w") as f:
+            json.dump(data, f)
+
+    def test_gauges_only_from_live_workers(self):
+        dead = 2 ** 22 + 1  # above any pid_max, so never alive
+        self.write(dead, {
+            "a2chatbot_openai_circuit_open": [[[], 1]],
+            "a2chatbot_openai_queue_depth": [[[], 7]],
+            "a2chatbot_openai_hedges_total": [[["eval"], 2]],
+        })
+        self.write(os.getpid(), {
+            "a2chatbot_openai_circuit_open": [[[], 0]],
+            "a2chatbot_openai_queue_depth": [[[], 1]],
+            "a2chatbot_openai_hedges_total": [[["eval"], 3]],
+        })
+        self.write(os.getppid(), {
+            "a2chatbot_openai_circuit_open": [[[], 1]],
+            "a2chatbot_openai_queue_depth": [[[], 2]],
+        })
+        with override_settings(METRICS_MULTIPROC_DIR=self.directory):
+            merged = metrics._merged_snapshots()
+        self.assertEqual(merged["a2chatbot_openai_circuit_open"], {(): 1})
+        self.assertEqual(merged["a2chatbot_openai_queue_depth"], {(): 3})
+        # Counters keep exited workers' counts
+        self.assertEqual(merged["a2chatbot_openai_hedges_total"], {("eval",): 5})
+
+
+@override_settings(OPENAI_MAX_RETRIES=0, OPENAI_STAGE_DEADLINES={"default": 5.0})
+class GradeAnswersTests(ResilienceTestCase):
+    def test_batch_failures_do_not_trip_the_serving_breaker(self):
+        circuit = resilience.CircuitBreaker(threshold=1, cooldown=60)
+        completions = llm.client.chat.completions
+        with mock.patch.object(completions, "create", StubCall(timeout_error())) as create:
+            for _ in range(2):
+                with self.assertRaises(resilience.Unavailable):
+                    grading.evaluate_correctness("truth", "answer", hedge_after=None, circuit=circuit)
+        self.assertEqual(len(create.calls), 1)
+        self.assertEqual(self.breaker._failures, 0)
+        self.assertTrue(resilience.breaker.allow())
+
+    def test_accuracy_ignores_unrecognised_labels(self):
+        results = [
+            {"human": "correct", "label": "correct"},
+            {"human": "maybe", "label": "other"},
+            {"human": "incorrect", "label": "correct"},
+            {"human": "idk", "label": "idk"},
+        ]
+        report = grade_answers.Command().confusion(results, "human")
+        self.assertEqual(report["items"], 4)
+        self.assertEqual(report["accuracy"], 0.5)
+        self.assertEqual(report["matrix"]["other"]["other"], 1)
+
+
+class SendMessageTurnTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="student", password="pw")
+        self.participant = Participant.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        handler = mock.patch.object(views, "handle_tutor_mode", side_effect=self.reply)
+        self.handler = handler.start()
+        self.addCleanup(handler.stop)
+
+    def reply(self, request, participant, studentmessage, budget):
+        return JsonResponse([{"bot_message": f"reply {self.handler.call_count}"}], safe=False)
+
+    def send(self, key="key-1"):
+        return self.client.post(reverse("sendmessage"), {"message": "hi", "idempotency_key": key})
+
+    def test_same_key_replays_the_reply(self):
+        first = self.send()
+        second = self.send()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(self.handler.call_count, 1)
+        self.assertEqual(TurnRequest.objects.get(key="key-1").status, "done")
+
+    def test_same_key_while_running_is_pending(self):
+        TurnRequest.objects.create(user=self.user, key="key-1")
+        response = self.send()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "pending")
+        self.handler.assert_not_called()
+
+    def test_busy_while_another_turn_holds_the_lease(self):
+        token = turns.acquire_lease(self.participant)
+        response = self.send(key="key-2")
+        self.assertEqual(response.status_code, 409)
+        self.handler.assert_not_called()
+        # The other turn keeps its lease
+        self.participant.refresh_from_db()
+        self.assertEqual(self.participant.turn_lease_token, token)
+
+    def test_lease_is_released_after_the_turn(self):
+        self.send()
+        self.participant.refresh_from_db()
+        self.assertIsNone(self.participant.turn_lease_token)
+        self.assertIsNone(self.participant.turn_lease_until)
+
+    def test_retry_after_abandoned_turn_runs_again(self):
+        self.handler.side_effect = admission.Overloaded(3)
+        self.assertEqual(self.send().status_code, 429)
+        self.assertFalse(TurnRequest.objects.filter(key="key-1").exists())
+
+        self.handler.side_effect = self.reply
+        response = self.send()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.handler.call_count, 2)
+
+    def test_stale_pending_key_expires(self):
+        TurnRequest.objects.create(user=self.user, key="key-1")
+        old = timezone.now() - timedelta(seconds=turns.lease_seconds() + 1)
+        TurnRequest.objects.filter(key="key-1").update(created_at=old)
+        self.assertEqual(self.send().status_code, 200)
+        self.handler.assert_called_once()
+
+    def test_pending_key_kept_while_its_turn_holds_the_lease(self):
+        TurnRequest.objects.create(user=self.user, key="key-1")
+        old = timezone.now() - timedelta(seconds=turns.lease_seconds() + 1)
+        TurnRequest.objects.filter(key="key-1").update(created_at=old)
+        turns.acquire_lease(self.participant)
+        self.assertEqual(self.send().status_code, 202)
+
+    def test_lost_lease_stops_the_turn(self):
+        def steal_lease(request, participant, studentmessage, budget):
+            Participant.objects.filter(pk=participant.pk).update(turn_lease_token="other")
+            turns.renew_lease(participant)
+
+        self.handler.side_effect = steal_lease
+        self.assertEqual(self.send().status_code, 409)
+        self.assertFalse(TurnRequest.objects.filter(key="key-1").exists())
+
+    def test_renew_extends_the_lease(self):
+        token = turns.acquire_lease(self.participant)
+        Participant.objects.filter(pk=self.participant.pk).update(turn_lease_until=timezone.now())
+        self.participant.turn_lease_token = token
+        turns.renew_lease(self.participant)
+        self.participant.refresh_from_db()
+        self.assertGreater(self.participant.turn_lease_until, timezone.now() + timedelta(seconds=60))
+
+
+class ExportChatlogTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="student", password="pw")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output = os.path.join(directory.name, "chatlog.jsonl")
+        self.checkpoint = os.path.join(directory.name, "state.json")
+        self.report = os.path.join(directory.name, "report.json")
+
+    def log(self, topic, question, label):
+        meta = {"mode": "tutor_asks", "topic": topic, "main_question": question, "correctness": label}
+        return ChatLog.objects.create(user=self.user, message="a", bot_reply="b", meta=meta)
+
+    def export(self):
+        call_command(
+            "export_chatlog", output=self.output, checkpoint=self.checkpoint, report=self.report,
+            stderr=io.StringIO(),
+        )
+        with open(self.output) as f:
+            return [json.loads(line)["id"] for line in f]
+
+    def test_rows_written_after_the_last_checkpoint_are_not_duplicated(self):
+        first = self.log("mutation", "Q1", "incorrect")
+        self.export()
+        with open(self.checkpoint) as f:
+            saved = f.read()
+
+        second = self.log("mutation", "Q1", "correct")
+        self.export()
+        # A run that exported but crashed before saving its checkpoint
+        with open(self.checkpoint, "w") as f:
+            f.write(saved)
+        self.assertEqual(self.export(), [first.id, second.id])
+
+    def test_mastery_is_tracked_per_topic(self):
+        self.log("mutation", "Q1", "correct")
+        self.log("genetics", "Q1", "incorrect")
+        self.log("genetics", "Q1", "correct")
+        self.export()
+        with open(self.report) as f:
+            report = json.load(f)
+        self.assertEqual(report["questions"]["Q1"]["mastered"], 2)
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.assertEqual(state["open"], {})
+        self.assertEqual(state["done"], [f"{self.user.pk}|genetics|Q1", f"{self.user.pk}|mutation|Q1"])
+
+
+@override_settings(OPENAI_PRICE_PER_MTOK={"prompt": 0.15, "cached": 0.075, "completion": 0.60})
+class TokenReportTests(TestCase):
+    def test_cached_tokens_are_stored_and_priced_at_the_cached_rate(self):
+        user = User.objects.create_user(username="student", password="pw")
+        usage.begin(user)
+        details = SimpleNamespace(cached_tokens=600_000)
+        reported = SimpleNamespace(prompt_tokens=1_000_000, completion_tokens=0, prompt_tokens_details=details)
+        usage.record("run", SimpleNamespace(usage=reported))
+        usage.flush(user)
+        self.assertEqual(TokenUsage.objects.get(user=user, stage="run").cached_tokens, 600_000)
+
+        out = io.StringIO()
+        call_command("token_report", stdout=out)
+        report = json.loads(out.getvalue())
+        run = report["stages"]["run"]
+        self.assertEqual(run["cached_tokens"], 600_000)
+        # 400k at the full rate and 600k at the cached rate
+        self.assertEqual(run["cost_usd"], 0.105)
+        self.assertEqual(report["top_users"][0]["cost_usd"], 0.105)
+
+
+class GovernorTests(SimpleTestCase):
+    def governor(self, rpm=600, max_queue=2, max_wait=5.0):
+        # Empty request bucket: each call waits 60/rpm seconds for its turn
+        governor = admission.Governor(rpm=rpm, tpm=10 ** 6, max_queue=max_queue, max_wait=max_wait)
+        governor.requests.level = 0
+        return governor
+
+    def start(self, governor, name, priority, outcomes):
+        def wait_for_admission():
+            try:
+                governor.acquire(priority)
+                outcomes.append((name, "served"))
+            except admission.Overloaded:
+                outcomes.append((name, "rejected"))
+
+        thread = threading.Thread(target=wait_for_admission)
+        thread.start()
+        return thread
+
+    def fill(self, governor, priority, outcomes):
+        threads = []
+        for n in range(governor.max_queue):
+            threads.append(self.start(governor, f"waiter{n}", priority, outcomes))
+            while governor.queue_depth() < n + 1:
+                time.sleep(0.005)
+        return threads
+
+    def finish(self, threads):
+        for thread in threads:
+            thread.join(5)
+
+    def test_full_queue_evicts_lower_priority_waiter(self):
+        governor, outcomes = self.governor(), []
+        threads = self.fill(governor, admission.PREFETCH, outcomes)
+        governor.acquire(admission.TURN)
+        outcomes.append(("turn", "served"))
+        self.finish(threads)
+        # The newest prefetch made room; the turn went ahead of the other one
+        self.assertEqual(dict(outcomes), {"waiter0": "served", "waiter1": "rejected", "turn": "served"})
+        self.assertLess(outcomes.index(("turn", "served")), outcomes.index(("waiter0", "served")))
+
+    def test_full_queue_rejects_equal_priority(self):
+        governor, outcomes = self.governor(), []
+        threads = self.fill(governor, admission.TURN, outcomes)
+        with self.assertRaises(admission.Overloaded):
+            governor.acquire(admission.TURN)
+        self.finish(threads)
+        self.assertEqual(sorted(outcomes), [("waiter0", "served"), ("waiter1", "served")])
+
+    def test_rejects_when_wait_exceeds_max_wait(self):
+        governor = self.governor(rpm=60, max_wait=0.2)
+        started = time.monotonic()
+        with self.assertRaises(admission.Overloaded) as cm:
+            governor.acquire(admission.TURN)
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+
+    def test_queue_depth_returns_to_zero(self):
+        governor, outcomes = self.governor(), []
+        threads = self.fill(governor, admission.PREFETCH, outcomes)
+        self.assertEqual(admission.QUEUE_DEPTH.snapshot()[()], 2)
+        with self.assertRaises(admission.Overloaded):
+            governor.acquire(admission.PREFETCH)
+        self.finish(threads)
+        self.assertEqual(governor.queue_depth(), 0)
+        self.assertEqual(admission.QUEUE_DEPTH.snapshot()[()], 0)
@@ -0,0 +1,174 @@
+"""
+Topic registry.
+
+A topic is one course unit, made of:
+- a QA set: data/<name>_qa.json
+- a retrieval index: the Chroma collection global_<name>
+- prompt wording from data/<name>_topic.json (optional). It has "title",
+  shown in the UI, and "subject", used in prompts ("a <subject> tutor").
+- precomputed per-question artifacts (see a2chatbot/artifacts.py), loaded
+  on first use and never built on the request path
+
+Topics are loaded on first use and only the TOPIC_CACHE_SIZE most recently
+used ones stay in memory. If a topic's QA file changes on disk, the topic is
+reloaded the next time it is accessed.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from a2chatbot import artifacts, prompts
+from a2chatbot.vectorstore import embedding_server_available, get_collection
+from a2chatbot.warmpool import background
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+QA_SUFFIX = "_qa.json"
+# Seconds before a topic looks for missing artifacts on disk again
+ARTIFACTS_RETRY = getattr(settings, "QUESTION_ARTIFACTS_RETRY", 60.0)
+
+
+class UnknownTopic(KeyError):
+    pass
+
+
+class Topic:
+    def __init__(self, name, qa, mtime, config):
+        self.name = name
+        self.qa = qa
+        self.mtime = mtime
+        self.title = config.get("title", name.replace("_", " ").title())
+        self.subject = config.get("subject", name.replace("_", " "))
+        self.collection_name = config.get("collection", f"global_{name}")
+        self._collection = None
+        self._artifacts = None
+        self._artifacts_retry_at = 0.0
+        self._artifacts_building = False
+        self._artifacts_lock = threading.Lock()
+
+    def question(self, index):
+        """
+        Return (index, question, answer), with the index clamped to the QA set.
+        """
+        idx = max(0, min(index, len(self.qa) - 1))
+        return idx, self.qa[idx]["question"], self.qa[idx]["answer"]
+
+    def collection(self):
+        if self._collection is None:
+            self._collection = get_collection(self.collection_name)
+        return self._collection
+
+    def artifacts(self):
+        """
+        The topic's QuestionArtifacts, or None if they aren't built (yet).
+        Only reads them from disk. A missing or stale store is looked for
+        again every ARTIFACTS_RETRY seconds and, if the embedding server is
+        running, rebuilt in the background; otherwise run
+        `seed_global_mutations --artifacts-only`.
+        """
+        with self._artifacts_lock:
+            if self._artifacts is not None or time.monotonic() < self._artifacts_retry_at:
+                return self._artifacts
+            self._artifacts = artifacts.load(self)
+            if self._artifacts is not None:
+                return self._artifacts
+            self._artifacts_retry_at = time.monotonic() + ARTIFACTS_RETRY
+            # Building in process would load the embedding model
+            if not embedding_server_available():
+                print(f"[WARN] No question artifacts for {self.name}; "
+                      "run `manage.py seed_global_mutations --artifacts-only`")
+                return None
+            if self._artifacts_building:
+                return None
+            self._artifacts_building = True
+        background(self._build_artifacts)
+        return None
+
+    def _build_artifacts(self):
+        try:
+            store = artifacts.build(self)
+        finally:
+            with self._artifacts_lock:
+                self._artifacts_building = False
+        with self._artifacts_lock:
+            self._artifacts = store
+
+    def opening_message(self, index):
+        # Rendered on every call, so prompt changes apply without a rebuild
+        idx, question, answer = self.question(index)
+        return prompts.question_opening_message(question, answer)
+
+
+class TopicRegistry:
+    def __init__(self, data_dir=DATA_DIR, max_loaded=4):
+        self.data_dir = data_dir
+        self.max_loaded = max_loaded
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()
+
+    def qa_path(self, name):
+        return os.path.join(self.data_dir, f"{name}{QA_SUFFIX}")
+
+    def available(self):
+        """
+        Names of all topics on disk (without loading them).
+        """
+        return sorted(
+            f[: -len(QA_SUFFIX)] for f in os.listdir(self.data_dir) if f.endswith(QA_SUFFIX)
+        )
+
+    def get(self, name):
+        path = self.qa_path(name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            raise UnknownTopic(name)
+
+        with self._lock:
+            topic = self._loaded.get(name)
+            if topic is not None and topic.mtime == mtime:
+                self._loaded.move_to_end(name)
+                return topic
+
+        topic = self._load(name, path, mtime)
+        with self._lock:
+            self._loaded[name] = topic
+            self._loaded.move_to_end(name)
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+        return topic
+
+    def loaded(self):
+        with self._lock:
+            return list(self._loaded)
+
+    def _load(self, name, path, mtime):
+        with open(path, "r") as f:
+            qa = json.load(f)
+        config = {}
+        config_path = os.path.join(self.data_dir, f"{name}_topic.json")
+        if os.path.exists(config_path):
+            with open(config_path, "r") as f:
+                config = json.load(f)
+        return Topic(name, qa, mtime, config)
+
+
+DEFAULT_TOPIC = getattr(settings, "DEFAULT_TOPIC", "mutation")
+
+registry = TopicRegistry(max_loaded=getattr(settings, "TOPIC_CACHE_SIZE", 4))
+
+
+def get_topic(name=None):
+    """
+    The named topic, or the default one if the name is empty or unknown.
+    """
+    if name:
+        try:
+            return registry.get(name)
+        except UnknownTopic:
+            pass
+    return registry.get(DEFAULT_TOPIC)
@@ -0,0 +1,139 @@
+"""
+Per-participant turn coordination.
+
+- A lease on the Participant row makes sure only one turn (and so one run on
+  the participant's thread) is in flight at a time, across all workers. It
+  is taken with a single conditional UPDATE, renewed before every assistant
+  run, and expires on its own if a worker dies mid-turn.
+- Client-supplied idempotency keys (TurnRequest) let a retried sendmessage
+  return the original reply, or "still working", instead of starting a
+  second run.
+
+Rapid consecutive messages are coalesced on the client, which sends whatever
+was typed while a turn was running as one message once the turn finishes.
+"""
+
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+
+from a2chatbot.models import Participant, TurnRequest
+
+
+# OpenAI stages that can run between two lease renewals: one assistant run
+# plus the calls around it (creating the assistant or thread, the eval call,
+# posting the message and reading the reply).
+LEASE_STAGES = ("assistant_create", "thread_create", "eval", "message_create", "run", "messages_list")
+# Retrieval, compression and database work on top of that
+LEASE_MARGIN = 30.0
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def lease_seconds():
+    """
+    TURN_LEASE_SECONDS if set, otherwise the worst case between two renewals:
+    the deadlines of LEASE_STAGES (which include their admission waits) plus
+    LEASE_MARGIN.
+    """
+    configured = getattr(settings, "TURN_LEASE_SECONDS", None)
+    if configured:
+        return configured
+    deadlines = getattr(settings, "OPENAI_STAGE_DEADLINES", {})
+    default = deadlines.get("default", 30.0)
+    return sum(deadlines.get(stage, default) for stage in LEASE_STAGES) + LEASE_MARGIN
+
+
+# ---------- Lease ----------
+
+def acquire_lease(participant):
+    """
+    Take the participant's turn lease. Returns a token, or None if another
+    turn holds it.
+    """
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    taken = (
+        Participant.objects.filter(pk=participant.pk)
+        .filter(Q(turn_lease_until__isnull=True) | Q(turn_lease_until__lt=now))
+        .update(turn_lease_token=token, turn_lease_until=now + timedelta(seconds=lease_seconds()))
+    )
+    return token if taken else None
+
+
+def renew_lease(participant):
+    """
+    Extend the lease held by this turn (participant.turn_lease_token) before
+    starting another long call. Raises LeaseLost if it expired and another
+    turn took it in the meantime.
+    """
+    token = participant.turn_lease_token
+    if token is None:
+        return  # not running under a lease (e.g. called outside sendmessage)
+    renewed = Participant.objects.filter(pk=participant.pk, turn_lease_token=token).update(
+        turn_lease_until=timezone.now() + timedelta(seconds=lease_seconds())
+    )
+    if not renewed:
+        raise LeaseLost(f"Turn lease of participant {participant.pk} was taken over")
+
+
+def release_lease(participant, token):
+    Participant.objects.filter(pk=participant.pk, turn_lease_token=token).update(
+        turn_lease_token=None, turn_lease_until=None
+    )
+
+
+# ---------- Idempotency keys ----------
+
+def find_turn(user, key):
+    """
+    The earlier request with this key, unless it was abandoned (still pending
+    although no turn has held the lease for a full lease period).
+    """
+    turn = TurnRequest.objects.filter(user=user, key=key).first()
+    if turn is None:
+        return None
+    now = timezone.now()
+    if (
+        turn.status == "pending"
+        and turn.created_at < now - timedelta(seconds=lease_seconds())
+        and not Participant.objects.filter(pk=user.pk, turn_lease_until__gt=now).exists()
+    ):
+        turn.delete()
+        return None
+    return turn
+
+
+def start_turn(user, key):
+    """
+    Record that the request with this key is running. Returns False if a
+    concurrent request with the same key got there first.
+    """
+    expire_turns(user)
+    try:
+        TurnRequest.objects.create(user=user, key=key)
+    except IntegrityError:
+        return False
+    return True
+
+
+def finish_turn(user, key, payload):
+    TurnRequest.objects.filter(user=user, key=key).update(status="done", response=payload)
+
+
+def abandon_turn(user, key):
+    """
+    Forget a request that failed, so a retry with the same key runs again.
+    """
+    TurnRequest.objects.filter(user=user, key=key, status="pending").delete()
+
+
+def expire_turns(user):
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, "IDEMPOTENCY_KEY_TTL", 86400))
+    TurnRequest.objects.filter(user=user, created_at__lt=cutoff).delete()
@@ -30,4 +30,8 @@ urlpatterns = [
     re_path(r"^next_question$", views.next_question, name="next_question"),
     path("set_question/<int:idx>/", views.set_question, name="set_question"),
     path("switch_mode/<str:mode>/", views.switch_mode, name="switch_mode"),
+    path("switch_topic/<str:name>/", views.switch_topic, name="switch_topic"),
+    path("history/", views.history, name="history"),
+    path("history/<int:turn_id>/context/", views.history_context, name="history_context"),
+    path("metrics", views.prometheus_metrics, name="metrics"),
 ]
@@ -0,0 +1,151 @@
+"""
+Token accounting and per-user daily budgets.
+
+Every OpenAI response that reports `usage` (chat completions and finished
+assistant runs) is recorded against the stage that made the call. At the end
+of a request the per-stage totals are stored in ChatLog.meta["usage"] and
+added to the user's TokenUsage row for the day.
+
+Budgets are checked before a turn starts:
+- under TOKEN_BUDGET_DAILY_SOFT: normal path
+- over the soft budget: cheaper path (smaller RAG budget, cached answers)
+- over TOKEN_BUDGET_DAILY_HARD: no OpenAI calls, local fallback replies
+"""
+
+import contextvars
+import threading
+
+from django.conf import settings
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from a2chatbot import metrics
+from a2chatbot.models import TokenUsage
+
+OK, SOFT, HARD = "ok", "soft", "hard"
+
+TOKENS = metrics.Counter(
+    "a2chatbot_openai_tokens_total",
+    "Tokens reported by OpenAI, by stage and kind (prompt, completion).",
+    ("stage", "kind"),
+)
+CACHED_TOKENS = metrics.Counter(
+    "a2chatbot_openai_cached_tokens_total",
+    "Prompt tokens served from OpenAI's prompt prefix cache, by stage.",
+    ("stage",),
+)
+BUDGET_TURNS = metrics.Counter(
+    "a2chatbot_budget_limited_turns_total",
+    "Turns served on a cheaper path because of the user's daily token budget.",
+    ("state",),
+)
+
+_usage = contextvars.ContextVar("a2chatbot_usage", default=None)
+_lock = threading.Lock()
+
+
+class _Collector:
+    def __init__(self, user=None):
+        self.user = user
+        self.stages = {}
+        self.flushed = False
+
+
+# ---------- Per-request collection ----------
+
+def begin(user=None):
+    """
+    Start collecting usage for the current request. Hedged attempts run in
+    copies of the request's context, so they report to the same collector.
+    """
+    _usage.set(_Collector(user))
+
+
+def record(stage, response):
+    """
+    Add the usage reported on an OpenAI response (if any) to `stage`.
+    A response that arrives after the request was flushed (the losing
+    attempt of a hedged call) goes straight to the user's daily totals.
+    """
+    reported = getattr(response, "usage", None)
+    if reported is None:
+        return
+    prompt = getattr(reported, "prompt_tokens", 0) or 0
+    completion = getattr(reported, "completion_tokens", 0) or 0
+    # Prompt-cache hits (not reported on every response type, e.g. older runs)
+    details = getattr(reported, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    TOKENS.inc(prompt, stage, "prompt")
+    TOKENS.inc(completion, stage, "completion")
+    CACHED_TOKENS.inc(cached, stage)
+
+    collector = _usage.get()
+    if collector is None:
+        return
+    with _lock:
+        late = collector.flushed
+        stages = {} if late else collector.stages
+        totals = stages.setdefault(stage, {"calls": 0, "prompt": 0, "cached": 0, "completion": 0})
+        totals["calls"] += 1
+        totals["prompt"] += prompt
+        totals["cached"] += cached
+        totals["completion"] += completion
+    if late and collector.user is not None:
+        _store(collector.user, stages)
+
+
+def flush(user):
+    """
+    Store the usage collected so far against the user's daily totals.
+    Returns it as {stage: {"calls", "prompt", "cached", "completion"}}.
+    Safe to call more than once; later calls store only what came in since.
+    """
+    collector = _usage.get()
+    if collector is None:
+        return {}
+    with _lock:
+        stages, collector.stages = collector.stages, {}
+        collector.user = user
+        collector.flushed = True
+    _store(user, stages)
+    return stages
+
+
+def _store(user, stages):
+    today = timezone.localdate()
+    for stage, totals in stages.items():
+        row, _ = TokenUsage.objects.get_or_create(user=user, day=today, stage=stage)
+        TokenUsage.objects.filter(pk=row.pk).update(
+            calls=F("calls") + totals["calls"],
+            prompt_tokens=F("prompt_tokens") + totals["prompt"],
+            cached_tokens=F("cached_tokens") + totals["cached"],
+            completion_tokens=F("completion_tokens") + totals["completion"],
+        )
+
+
+# ---------- Budgets ----------
+
+def tokens_today(user):
+    totals = TokenUsage.objects.filter(user=user, day=timezone.localdate()).aggregate(
+        prompt=Sum("prompt_tokens"), completion=Sum("completion_tokens")
+    )
+    return (totals["prompt"] or 0) + (totals["completion"] or 0)
+
+
+def budget_state(user):
+    """
+    OK, SOFT or HARD, from the tokens the user has used today.
+    """
+    soft = getattr(settings, "TOKEN_BUDGET_DAILY_SOFT", None)
+    hard = getattr(settings, "TOKEN_BUDGET_DAILY_HARD", None)
+    if not soft and not hard:
+        return OK
+    used = tokens_today(user)
+    if hard and used >= hard:
+        state = HARD
+    elif soft and used >= soft:
+        state = SOFT
+    else:
+        return OK
+    BUDGET_TURNS.inc(1, state)
+    return state
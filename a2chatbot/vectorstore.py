@@ -1,15 +1,119 @@
+import os
+import socket
+import struct
+from array import array
+
 import chromadb
-from sentence_transformers import SentenceTransformer
 import pdfplumber
+from django.conf import settings
+
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+# Unix socket of the shared embedding server (`manage.py embedding_server`).
+# When it isn't running we fall back to loading the model in this process.
+# Set EMBEDDING_SOCKET="" to always encode in process.
+EMBEDDING_SOCKET = os.getenv("EMBEDDING_SOCKET", "/tmp/a2chatbot-embed.sock")
+EMBEDDING_TIMEOUT = 30.0
+
+_chroma_client = None
+_model = None
 
-chroma_client = chromadb.PersistentClient(path="./chromadb_storage")
-model = SentenceTransformer('all-MiniLM-L6-v2')
+def get_chroma_client():
+    """
+    Open the Chroma store (CHROMA_PATH) on first use rather than on import.
+    """
+    global _chroma_client
+    if _chroma_client is None:
+        _chroma_client = chromadb.PersistentClient(path=getattr(settings, "CHROMA_PATH", "./chromadb_storage"))
+    return _chroma_client
 
 def get_collection(name):
-    return chroma_client.get_or_create_collection(name)
+    return get_chroma_client().get_or_create_collection(name)
+
+def get_model():
+    """
+    Load the sentence-transformers model on first use. Importing it pulls in
+    torch, so workers that use the embedding server never pay for it.
+    """
+    global _model
+    if _model is None:
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer(EMBEDDING_MODEL)
+    return _model
+
+def encode_locally(text_list):
+    return get_model().encode(text_list).tolist()
+
+def embedding_server_available():
+    return bool(EMBEDDING_SOCKET) and os.path.exists(EMBEDDING_SOCKET)
 
 def embed_text(text_list):
-    return model.encode(text_list).tolist()
+    if embedding_server_available():
+        try:
+            return embed_via_server(text_list)
+        except OSError as e:
+            print("[WARN] Embedding server unavailable, encoding in process:", e)
+    return encode_locally(text_list)
+
+# ---------- Embedding server wire format ----------
+# request:  u32 count, then per text: u32 byte length + UTF-8 bytes
+# response: u32 count, u32 dim, then count*dim float32 (native byte order,
+#           client and server share a host); count == ERROR_MARKER means
+#           an error follows as u32 length + UTF-8 message.
+
+ERROR_MARKER = 0xFFFFFFFF
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Embedding connection closed mid-message")
+        buf.extend(chunk)
+    return bytes(buf)
+
+def pack_texts(text_list):
+    parts = [struct.pack("!I", len(text_list))]
+    for text in text_list:
+        data = text.encode("utf-8")
+        parts.append(struct.pack("!I", len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+def read_texts(sock):
+    (count,) = struct.unpack("!I", recv_exact(sock, 4))
+    texts = []
+    for _ in range(count):
+        (length,) = struct.unpack("!I", recv_exact(sock, 4))
+        texts.append(recv_exact(sock, length).decode("utf-8"))
+    return texts
+
+def pack_vectors(vectors):
+    dim = len(vectors[0]) if vectors else 0
+    values = array("f")
+    for vector in vectors:
+        values.extend(vector)
+    return struct.pack("!II", len(vectors), dim) + values.tobytes()
+
+def pack_error(message):
+    data = message.encode("utf-8")
+    return struct.pack("!II", ERROR_MARKER, len(data)) + data
+
+def read_vectors(sock):
+    count, dim = struct.unpack("!II", recv_exact(sock, 8))
+    if count == ERROR_MARKER:
+        raise ConnectionError(recv_exact(sock, dim).decode("utf-8"))
+    values = array("f")
+    values.frombytes(recv_exact(sock, count * dim * values.itemsize))
+    flat = values.tolist()
+    return [flat[i * dim:(i + 1) * dim] for i in range(count)]
+
+def embed_via_server(text_list):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(EMBEDDING_TIMEOUT)
+        sock.connect(EMBEDDING_SOCKET)
+        sock.sendall(pack_texts(text_list))
+        return read_vectors(sock)
 
 def extract_text_from_pdf(file_path):
     text = ""
@@ -1,235 +1,364 @@
 from __future__ import unicode_literals
 
-import os
 import json
-from functools import lru_cache
+import base64
+from datetime import datetime
+from functools import partial
 
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.auth import login
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.fields.json import KeyTextTransform
 
-from dotenv import load_dotenv
-from openai import OpenAI
+import openai
 
+from a2chatbot import admission, compression, metrics, prompts, resilience, turns, usage
+from a2chatbot.topics import get_topic, registry as topic_registry
+from a2chatbot.warmpool import WarmThreadPool, background
 from a2chatbot.models import Participant, ChatLog
-from a2chatbot.vectorstore import get_collection, embed_text
+from a2chatbot.grading import evaluate_correctness, fallback_label
+from a2chatbot.llm import client, openai_call
+from a2chatbot.prompts import CORRECTNESS_LABELS
+from a2chatbot.vectorstore import embed_text
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-topic = "mutation"
-
-
-@lru_cache(maxsize=1)
-def load_ground_truth():
+def topic_for(participant):
     """
-    Load the mutation_qa.json once and cache it.
+    The participant's selected topic (QA set, retrieval index, prompt wording).
     """
-    fpath = os.path.join(os.path.dirname(__file__), "data", "mutation_qa.json")
-    with open(fpath, "r") as f:
-        return json.load(f)
+    return get_topic(participant.topic)
 
 
 # ---------- Persona builder ----------
 
-def build_persona(level, summary):
+def build_persona(level, summary, topic):
     """
     Creates a persona prompt for the tutor using student's level + summary.
-    Called once at registration.
+    Called once at registration. Returns "" if OpenAI is unavailable, in which
+    case the default persona is used.
     """
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You generate tutor personas."},
-            {
-                "role": "user",
-                "content": f"""
-Create a teaching persona for a mutation tutor.
-
-The student self-rated their understanding as: {level}
-
-The student wrote this summary of the mutation video:
-\"\"\"{summary}\"\"\"
-
-Create a short persona (5–7 sentences) describing:
-- how the tutor should speak
-- how patient/detailed to be
-- how Socratic vs explanatory
-- how much scientific depth to use
-- how to adapt to this level
-""",
-            },
-        ],
-        max_tokens=300,
-    )
+    try:
+        resp = openai_call(
+            "persona",
+            client.chat.completions.create,
+            priority=admission.REGISTRATION,
+            tokens=admission.estimate_tokens(summary, completion=400),
+            model="gpt-4o-mini",
+            messages=prompts.persona_messages(topic.subject, level, summary),
+            max_tokens=300,
+        )
+    except resilience.Unavailable:
+        return ""
     return resp.choices[0].message.content.strip()
 
 
-# ---------- Assistant & thread helpers ----------
-def handle_tutor_mode(request, participant, studentmessage):
-    qa = load_ground_truth()
-    idx = max(0, min(participant.current_q_index, len(qa) - 1))
-    main_question = qa[idx]["question"]
-    ground_truth = qa[idx]["answer"]
-
-    assistant_id = ensure_assistant(participant)
-
-    if not participant.current_thread_id:
-        thread_id = start_thread_for_current_question(participant, main_question, ground_truth)
-    else:
-        thread_id = participant.current_thread_id
-
-    rag_context = get_rag_context(studentmessage)
-    # Step A: Evaluate correctness using the ground truth
-    eval_prompt = f"""
-    Ground truth answer:
-    {ground_truth}
+# ---------- Assistant runs ----------
 
-    Student answer:
-    "{studentmessage}"
+# Prompt tokens an assistant run adds on top of the new message
+# (instructions + thread history), used for TPM admission.
+RUN_TOKEN_ESTIMATE = 2500
 
-    Classify the student's answer as one of:
-    1. correct
-    2. partially correct
-    3. incorrect
-    4. idk (if they say 'I don't know')
 
-    Only output the label.
+def run_assistant_turn(thread_id, assistant_id, user_content, guidance=None, response_format=None):
     """
+    Post the turn's prompt to the thread, run the assistant and return its reply.
+    `guidance` is passed as the run's additional_instructions.
+    """
+    run_options = {"response_format": response_format} if response_format else {}
+    if guidance:
+        run_options["additional_instructions"] = guidance
 
-    eval_resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": eval_prompt}],
-        max_tokens=10
-    )
-
-    print(eval_resp)
-
-    correctness_label = eval_resp.choices[0].message.content.strip().lower()
-    user_content = f"""
-Main question: {main_question}
-
-The student said:
-"{studentmessage}"
-
-Relevant transcript excerpts:
-{rag_context}
-
-Your evaluation of correctness:
-{correctness_label}
-
-Guidance:
-- If 'correct': reinforce positively and add a very short explanation.
-- If 'partially correct': praise effort, fix misconceptions, ask a follow-up.
-- If 'incorrect': be gentle, break it down, ask a simpler sub-question.
-- If 'idk': give a hint or a multiple-choice follow-up.
-
-----------------------------------------------
-Your task for THIS turn:
-----------------------------------------------
-1. Follow Guidance instructions based on correctness
-2. Provide a short scaffold:
-     - encouragement ( DO NOT display this title )
-     - mini-hint OR step-by-step clue
-     - short explanation (only if needed)
-3. Ask ONE follow-up question:
-   - Use either: MCQ, fill-in-the-blank, or short-answer.
-4. Keep output well-structured with bold text and bullet points.
-5. Stay focused **only** on this main question.
-"""
-    client.beta.threads.messages.create(
+    openai_call(
+        "message_create",
+        client.beta.threads.messages.create,
         thread_id=thread_id,
         role="user",
-        content=user_content
+        content=user_content,
     )
 
-    run = client.beta.threads.runs.create_and_poll(
+    run = openai_call(
+        "run",
+        partial(
+            resilience.create_and_poll,
+            client.beta.threads.runs,
+            # every poll is a request too
+            admit=partial(admission.governor.acquire, admission.TURN),
+        ),
+        tokens=admission.estimate_tokens(user_content, guidance or "", completion=RUN_TOKEN_ESTIMATE),
         thread_id=thread_id,
         assistant_id=assistant_id,
         temperature=0.7,
+        **run_options,
     )
 
-    reply = client.beta.threads.messages.list(
+    return openai_call(
+        "messages_list",
+        client.beta.threads.messages.list,
         thread_id=thread_id,
-        run_id=run.id
+        run_id=run.id,
     ).data[0].content[0].text.value
 
-    ChatLog.objects.create(
-        user=request.user,
-        message=studentmessage,
-        bot_reply=reply,
-        context=rag_context,
-        meta={"mode": "tutor_asks", "main_question": main_question,"correctness": correctness_label},
-    )
 
-    return JsonResponse([{"bot_message": reply}], safe=False)
+# ---------- Local fallbacks (used when OpenAI is unavailable) ----------
 
+# Errors that degrade a turn to the local fallback instead of failing it:
+# OpenAI unavailable, or an API error a retry would not fix (e.g. a 400)
+FALLBACK_ERRORS = (resilience.Unavailable, openai.OpenAIError)
 
-def handle_student_mode(request, participant, studentmessage):
 
-    # 1. Ensure assistant exists (but with student-mode instructions)
-    assistant_id = ensure_student_mode_assistant(participant)
+def log_fallback(stage, exc):
+    if not isinstance(exc, resilience.Unavailable):
+        print(f"[WARN] {stage} failed, using the local fallback:", exc)
 
-    # 2. Ensure thread exists
-    if not participant.current_thread_id:
-        thread_id = start_student_mode_thread(participant)
+
+def fallback_reply(rag_context, main_question=None, budget_exhausted=False):
+    """
+    Short canned reply built from the retrieved transcript excerpts.
+    """
+    excerpt = rag_context.split("\n\n")[0] if rag_context else ""
+    words = excerpt.split()
+    if len(words) > 80:
+        excerpt = " ".join(words[:80]) + " …"
+
+    if budget_exhausted:
+        reply = "⚠️ You've reached today's tutoring limit, so here is a pointer from the video instead.\n\n"
+    else:
+        reply = "⚠️ I'm having trouble reaching the tutor right now, so here is a pointer from the video instead.\n\n"
+    if excerpt:
+        reply += f"> {excerpt}\n\n"
+    if main_question:
+        reply += f"Think about how this connects to the question: **{main_question}**\n\n"
+    if budget_exhausted:
+        reply += "The full tutor will be back tomorrow."
     else:
-        thread_id = participant.current_thread_id
+        reply += "Please send your message again in a moment to continue."
+    return reply
 
-    # 3. Retrieve RAG context
-    rag_context = get_rag_context(studentmessage)
 
-    # 4. Message prompt
-    user_content = f"""
-The student asked:
-"{studentmessage}"
+def cached_student_answer(topic, studentmessage):
+    """
+    The most recent tutor reply to the same question on this topic, as
+    (reply, context), or None. Used once a user is over the soft budget.
+    """
+    return (
+        ChatLog.objects.filter(
+            message__iexact=studentmessage.strip(),
+            meta__mode="student_asks",
+            meta__topic=topic.name,
+            meta__degraded__isnull=True,
+        )
+        .order_by("-id")
+        .values_list("bot_reply", "context")
+        .first()
+    )
 
-Relevant video transcript:
-{rag_context}
 
-Your teaching goals:
-1. Provide a concise, friendly explanation.
-2. Highlight key terms with **bold**.
-3. Then ask a follow-up question based on their question.
-4. Use either:
-   - a short MCQ, or
-   - fill-in-the-blank.
-5. Encourage the student.
+# ---------- Tutor-mode turns ----------
+
+TUTOR_TURNS = metrics.Counter(
+    "a2chatbot_tutor_turns_total",
+    "Tutor-mode turns by path (combined run, combined with fallback, two calls).",
+    ("path",),
+)
+
+# Structured output for the combined turn: label and reply in one run.
+TUTOR_TURN_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "tutor_turn",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "correctness": {"type": "string", "enum": CORRECTNESS_LABELS},
+                "reply": {"type": "string"},
+            },
+            "required": ["correctness", "reply"],
+            "additionalProperties": False,
+        },
+    },
+}
 
-Keep the response SHORT and structured.
-"""
 
-    client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=user_content
+def parse_tutor_turn(text):
+    """
+    Validate a combined-turn response against TUTOR_TURN_FORMAT.
+    Returns (label, reply); either is None if missing or invalid.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None, None
+    if not isinstance(data, dict):
+        return None, None
+
+    label = data.get("correctness")
+    label = label.strip().lower() if isinstance(label, str) else None
+    if label not in CORRECTNESS_LABELS:
+        label = None
+    reply = data.get("reply")
+    if not isinstance(reply, str) or not reply.strip():
+        reply = None
+    return label, reply
+
+
+def combined_tutor_turn(thread_id, assistant_id, main_question, studentmessage, rag_context):
+    """
+    Get the correctness label and the tutoring reply from a single run.
+    """
+    text = run_assistant_turn(
+        thread_id,
+        assistant_id,
+        prompts.combined_turn_prompt(main_question, studentmessage, rag_context),
+        guidance=prompts.TUTOR_TURN_GUIDANCE,
+        response_format=TUTOR_TURN_FORMAT,
     )
+    return parse_tutor_turn(text)
 
-    run = client.beta.threads.runs.create_and_poll(
-        thread_id=thread_id,
-        assistant_id=assistant_id,
-        temperature=0.7,
-    )
 
-    reply = client.beta.threads.messages.list(
-        thread_id=thread_id,
-        run_id=run.id
-    ).data[0].content[0].text.value
+# ---------- Assistant & thread helpers ----------
+def handle_tutor_mode(request, participant, studentmessage, budget=usage.OK):
+    topic = topic_for(participant)
+    idx, main_question, ground_truth = topic.question(participant.current_q_index)
+
+    rag_context, rag_tokens = get_rag_context(studentmessage, topic, budget, q_index=idx)
+    store = topic.artifacts()
+    truth_vector = store.ground_truth_vector(idx) if store is not None else None
+    degraded = False
+    correctness_label = reply = None
+    turn_path = "two_call"
+
+    try:
+        if budget == usage.HARD:
+            raise resilience.Unavailable("Daily token budget used up")
+
+        with metrics.span("assistant"):
+            assistant_id = ensure_assistant(participant)
+        thread_id = get_or_create_thread(participant)
+
+        # One run that returns both the label and the reply
+        if getattr(settings, "TUTOR_COMBINED_TURN", True):
+            turns.renew_lease(participant)
+            correctness_label, reply = combined_tutor_turn(
+                thread_id, assistant_id, main_question, studentmessage, rag_context
+            )
+            turn_path = "combined" if reply is not None and correctness_label is not None else "combined_fallback"
+
+        # Otherwise (or if its output didn't validate): the two-call path
+        if correctness_label is None:
+            # Step A: Evaluate correctness using the ground truth
+            try:
+                correctness_label = evaluate_correctness(ground_truth, studentmessage)
+            except FALLBACK_ERRORS as e:
+                log_fallback("eval", e)
+                correctness_label = fallback_label(ground_truth, studentmessage, truth_vector)
+                degraded = True
+
+        if reply is None:
+            user_content = prompts.tutor_turn_prompt(main_question, studentmessage, rag_context, correctness_label)
+            turns.renew_lease(participant)
+            reply = run_assistant_turn(thread_id, assistant_id, user_content, guidance=prompts.TUTOR_TURN_GUIDANCE)
+    except FALLBACK_ERRORS as e:
+        log_fallback("tutor turn", e)
+        if correctness_label is None:
+            correctness_label = fallback_label(ground_truth, studentmessage, truth_vector)
+        reply = fallback_reply(rag_context, main_question, budget_exhausted=budget == usage.HARD)
+        degraded = True
+
+    TUTOR_TURNS.inc(1, turn_path)
+
+    # The tutor asks whether to move on once the question is mastered:
+    # prepare the next question's thread while the student reads the reply.
+    if MASTERY_PHRASE in reply.lower() and idx < len(topic.qa) - 1:
+        thread_pool.prefetch(opening_message_for(participant, idx + 1))
+
+    meta = {
+        "mode": "tutor_asks",
+        "topic": topic.name,
+        "main_question": main_question,
+        "correctness": correctness_label,
+        "turn_path": turn_path,
+        "rag_tokens": rag_tokens,
+    }
+    if degraded:
+        meta["degraded"] = True
+    if budget != usage.OK:
+        meta["budget"] = budget
+    log_chat(request.user, studentmessage, reply, rag_context, meta)
 
-    ChatLog.objects.create(
-        user=request.user,
-        message=studentmessage,
-        bot_reply=reply,
-        context=rag_context,
-        meta={"mode": "student_asks"},
-    )
+    return JsonResponse([{"bot_message": reply}], safe=False)
+
+
+def handle_student_mode(request, participant, studentmessage, budget=usage.OK):
+    topic = topic_for(participant)
+
+    # Over budget: answer a repeated question from an earlier reply
+    if budget != usage.OK:
+        cached = cached_student_answer(topic, studentmessage)
+        if cached is not None:
+            reply, rag_context = cached
+            meta = {"mode": "student_asks", "topic": topic.name, "budget": budget, "cached": True}
+            log_chat(request.user, studentmessage, reply, rag_context, meta)
+            return JsonResponse([{"bot_message": reply, "rag_context": rag_context}], safe=False)
+
+    # 1. Retrieve RAG context
+    rag_context, rag_tokens = get_rag_context(studentmessage, topic, budget)
+
+    # 2. Message prompt
+    user_content = prompts.student_turn_prompt(studentmessage, rag_context)
+
+    meta = {"mode": "student_asks", "topic": topic.name, "rag_tokens": rag_tokens}
+    if budget != usage.OK:
+        meta["budget"] = budget
+    try:
+        if budget == usage.HARD:
+            raise resilience.Unavailable("Daily token budget used up")
+
+        # 3. Ensure assistant exists (but with student-mode instructions)
+        with metrics.span("assistant"):
+            assistant_id = ensure_student_mode_assistant(participant)
+
+        # 4. Ensure thread exists
+        if not participant.current_thread_id:
+            thread_id = start_student_mode_thread(participant)
+        else:
+            thread_id = participant.current_thread_id
+
+        turns.renew_lease(participant)
+        reply = run_assistant_turn(thread_id, assistant_id, user_content, guidance=prompts.STUDENT_TURN_GUIDANCE)
+    except FALLBACK_ERRORS as e:
+        log_fallback("student turn", e)
+        reply = fallback_reply(rag_context, budget_exhausted=budget == usage.HARD)
+        meta["degraded"] = True
+
+    log_chat(request.user, studentmessage, reply, rag_context, meta)
 
     return JsonResponse([{"bot_message": reply,"rag_context": rag_context}], safe=False)
 
 
+def log_chat(user, studentmessage, reply, rag_context, meta):
+    """
+    Store one turn in ChatLog, with the tokens it used and per-stage timings
+    if enabled.
+    """
+    meta["usage"] = usage.flush(user)
+    if getattr(settings, "CHATLOG_TIMINGS", True):
+        meta["timings"] = metrics.request_timings()
+    with metrics.span("chatlog_insert"):
+        ChatLog.objects.create(
+            user=user,
+            message=studentmessage,
+            bot_reply=reply,
+            context=rag_context,
+            meta=meta,
+        )
+
+
 def get_or_create_participant(user):
     """
     Ensure a Participant row exists for this user.
@@ -247,75 +376,22 @@ def create_assistant_for_participant(participant):
     Create an OpenAI assistant using the stored persona.
     Save assistant_id on Participant.
     """
-    persona = participant.persona or "You are a patient mutation tutor."
+    topic = topic_for(participant)
+    persona = participant.persona or f"You are a patient {topic.subject} tutor."
 
-    instructions = f"""
-You are a personalized mutation tutor guiding the student through ONE specific question at a time.
+    instructions = prompts.tutor_instructions(topic.subject, persona, participant.level)
 
-Your teaching persona:
-{persona}
-
-Student level: {participant.level}
-
-----------------------------------------------
-TEACHING BEHAVIOR REQUIREMENTS
-----------------------------------------------
-
-1. **Evaluate correctness**
-   - If the student’s response is correct → acknowledge, reinforce, and deepen slightly.
-   - If partially correct → encourage and give a hint that pushes them one step further.
-   - If incorrect → gently point out the misunderstanding and give a scaffolded hint.
-
-2. **Handle “I don’t know”**
-   - Respond with: 
-     - a simple explanation,
-     - a clue,
-     - then a very small follow-up question.
-
-3. **Use Socratic scaffolding**
-   - Ask small guiding questions before giving explanations.
-   - Only reveal the full explanation if the student struggles.
-
-4. **Deliberate practice**
-   - Ask 1 follow-up question per turn.
-   - Follow-ups should target the specific misconception or missing detail.
-
-5. **Question format variety**
-   Mix formats:
-      - short-answer prompt  
-      - multiple choice  
-      - fill-in-the-blank  
-      - “choose the correct statement”  
-
-6. **Tone**
-   - Supportive, encouraging, patient.
-   - Use phrases like “Great attempt!”, “You’re on the right track”, “Let’s think step-by-step.”
-
-7. **Structured output**
-   Format your replies using:
-      - **bold** for key terms  
-      - bullet points  
-      - small emojis (✨, 🧬, 🟦) for friendliness  
-
-8. **Stay ONLY on the current main question**
-   Do not introduce unrelated concepts unless the student asks.
-
-9. **Detect mastery**
-   If the student gives a complete, correct explanation:
-      - Provide a brief summary
-      - Ask: “Would you like to move to the next question?”
-
-"""
-
-    assistant = client.beta.assistants.create(
-        name=f"Mutation Tutor for {participant.user.username}",
+    assistant = openai_call(
+        "assistant_create",
+        client.beta.assistants.create,
+        name=f"{topic.title} Tutor for {participant.user.username}",
         instructions=instructions,
         model="gpt-4o-mini",
         temperature=0.7,
     )
 
     participant.assistant_id = assistant.id
-    participant.save()
+    participant.save(update_fields=["assistant_id", "updated_at"])
     return assistant.id
 
 
@@ -332,156 +408,191 @@ def ensure_student_mode_assistant(participant):
     # If an assistant exists but mode is different (tutor), delete it
     if participant.assistant_id and participant.mode != "student_asks":
         try:
-            client.beta.assistants.delete(participant.assistant_id)
+            openai_call("assistant_delete", client.beta.assistants.delete, assistant_id=participant.assistant_id)
         except:
             pass
         participant.assistant_id = None
-        participant.save()
+        participant.save(update_fields=["assistant_id", "updated_at"])
 
     # If correct assistant already exists
     if participant.assistant_id:
         return participant.assistant_id
 
-    persona = participant.persona or "You are a friendly mutation tutor."
-
-    instructions = f"""
-You are a mutation tutor in STUDENT-ASKS MODE.
-
-Your persona:
-{persona}
-
-----------------------------------------------
-TEACHING BEHAVIOR RULES
-----------------------------------------------
-
-1. **Concise concept explanation**
-   - 3–5 short sentences max.
-   - Always define key biological terms with **bold**.
-
-2. **Correctness checking**
-   - If the student’s question reveals a misconception, correct it gently.
-
-3. **Follow-up question each turn**
-   After the explanation, ask ONE:
-      - multiple-choice question (MCQ), OR  
-      - fill-in-the-blank  
-
-   The follow-up must reinforce the *same concept* the student asked about.
-
-4. **Encouragement**
-   Use friendly, motivating tone:
-   - “Good question!”  
-   - “Nice thinking—let’s explore that.”  
+    topic = topic_for(participant)
+    persona = participant.persona or f"You are a friendly {topic.subject} tutor."
 
-5. **I don’t know handling**
-   If student shows confusion:
-      - Give a simple explanation
-      - Ask an easy MCQ to rebuild confidence
+    instructions = prompts.student_mode_instructions(topic.subject, persona)
 
-6. **Structure**
-   Use:
-     - **bold terms**
-     - bullet points
-     - 1 emoji max per message
-"""
-
-    assistant = client.beta.assistants.create(
-        name=f"Mutation Tutor (Student Mode) for {participant.user.username}",
+    assistant = openai_call(
+        "assistant_create",
+        client.beta.assistants.create,
+        name=f"{topic.title} Tutor (Student Mode) for {participant.user.username}",
         instructions=instructions,
         model="gpt-4o-mini",
         temperature=0.7,
     )
 
     participant.assistant_id = assistant.id
-    participant.save()
+    participant.save(update_fields=["assistant_id", "updated_at"])
 
     return assistant.id
 
 
-def start_student_mode_thread(participant):
-    thread = client.beta.threads.create(
+STUDENT_MODE_OPENING = "You are now in student-asks mode. Begin teaching."
+
+# Phrase the tutor uses once the student has mastered the current question.
+MASTERY_PHRASE = "move to the next question"
+
+
+def create_thread(opening, priority=admission.TURN):
+    """
+    Create a thread whose first message is `opening` and return its id.
+    """
+    thread = openai_call(
+        "thread_create",
+        client.beta.threads.create,
+        priority=priority,
         messages=[
-            {"role": "user", "content": "You are now in student-asks mode. Begin teaching."}
+            {"role": "user", "content": opening}
         ]
     )
-    participant.current_thread_id = thread.id
-    participant.save()
     return thread.id
 
 
-def start_thread_for_current_question(participant, main_question, ground_truth):
+def delete_thread(thread_id):
+    openai_call("thread_delete", client.beta.threads.delete,
+                priority=admission.PREFETCH, thread_id=thread_id)
+
+
+thread_pool = WarmThreadPool(
+    lambda opening: create_thread(opening, priority=admission.PREFETCH),
+    size=getattr(settings, "WARM_THREAD_POOL_SIZE", 1),
+    discard=delete_thread,
+    ttl=getattr(settings, "WARM_THREAD_TTL", 900.0),
+    max_ready=getattr(settings, "WARM_THREAD_POOL_MAX", 50),
+)
+
+
+def start_student_mode_thread(participant):
+    thread_id = thread_pool.take(STUDENT_MODE_OPENING) or create_thread(STUDENT_MODE_OPENING)
+    participant.current_thread_id = thread_id
+    participant.save(update_fields=["current_thread_id", "updated_at"])
+    return thread_id
+
+
+def start_thread_for_current_question(participant):
     """
-    Create a thread that is specific to the current question.
-    The first message tells the assistant which question we are focusing on
-    and what the ground truth is (for internal reference).
+    Create a thread that is specific to the current question, taking a
+    pre-created one from the warm pool when available.
     """
-    content = f"""
-You are now focusing on this main question:
+    content = topic_for(participant).opening_message(participant.current_q_index)
+    thread_id = thread_pool.take(content) or create_thread(content)
 
-Q: {main_question}
+    participant.current_thread_id = thread_id
+    participant.save(update_fields=["current_thread_id", "updated_at"])
+    return thread_id
 
-Ground-truth (for your internal reference only; do NOT just dump this as an answer):
-{ground_truth}
 
-Your job:
-- Use this ground truth to judge the student's understanding.
-- Ask good questions, give hints, and explain when they are stuck.
-- Stay on this question until the student is done.
-"""
+def opening_message_for(participant, q_index=None):
+    """
+    Opening message of the thread the participant needs for their current
+    mode (and question, or `q_index` if given, in tutor mode).
+    """
+    if participant.mode != "tutor_asks":
+        return STUDENT_MODE_OPENING
+    if q_index is None:
+        q_index = participant.current_q_index
+    return topic_for(participant).opening_message(q_index)
 
-    thread = client.beta.threads.create(
-        messages=[
-            {"role": "user", "content": content}
-        ]
-    )
 
-    participant.current_thread_id = thread.id
-    participant.save()
-    return thread.id
+def reset_thread(participant):
+    """
+    Retire the participant's thread in the background and switch them to a
+    pre-created thread for their current question/mode, if one is ready.
+    The caller saves the participant.
+    """
+    if participant.current_thread_id:
+        background(delete_thread, participant.current_thread_id)
+    participant.current_thread_id = thread_pool.take(opening_message_for(participant))
 
 
-def get_or_create_thread(participant, main_question, ground_truth):
+def get_or_create_thread(participant):
     """
     Ensure there's a thread for the current question.
     If not, create a new one.
     """
     if participant.current_thread_id:
         return participant.current_thread_id
-    return start_thread_for_current_question(participant, main_question, ground_truth)
+    return start_thread_for_current_question(participant)
 
 
 # ---------- RAG helper ----------
 
-def get_rag_context(studentmessage):
+def get_rag_context(studentmessage, topic, budget=usage.OK, q_index=None):
     """
-    Always retrieve some transcript chunks related to the student's message.
+    Always retrieve some transcript chunks related to the student's message,
+    from the topic's collection, compressed to the RAG token budget (a smaller
+    one for users over their daily soft budget).
+    With `q_index` (tutor mode), the chunks precomputed for that question are
+    blended in, and fewer are retrieved for the message itself.
+    Returns (context_text, token_stats).
     """
-    global_coll = get_collection("global_mutation")
-    query_emb = embed_text([studentmessage])
-    results = global_coll.query(query_embeddings=query_emb, n_results=3)
+    store = topic.artifacts() if q_index is not None else None
+    question_chunks = []
+    query = studentmessage
+    if store is not None:
+        idx, main_question, _ = topic.question(q_index)
+        question_chunks = store.chunks(idx)[: getattr(settings, "RAG_QUESTION_CHUNKS", 2)]
+        query = f"{main_question}\n{studentmessage}"
+
+    with metrics.span("rag_embed"):
+        query_emb = embed_text([studentmessage])
+    with metrics.span("rag_query"):
+        results = topic.collection().query(
+            query_embeddings=query_emb, n_results=2 if question_chunks else 3
+        )
     context_passages = results["documents"][0] if results["documents"] else []
-    context_text = "\n\n".join(context_passages)
-    return context_text
+    context_passages += [c for c in question_chunks if c not in context_passages]
+
+    if not getattr(settings, "RAG_COMPRESSION", True):
+        return "\n\n".join(context_passages), None
+    context_text, tokens_before, tokens_after = compression.compress(
+        query,
+        context_passages,
+        budget=(
+            getattr(settings, "RAG_TOKEN_BUDGET_REDUCED", 120)
+            if budget != usage.OK
+            else getattr(settings, "RAG_TOKEN_BUDGET", 300)
+        ),
+        mmr_lambda=getattr(settings, "RAG_MMR_LAMBDA", 0.7),
+    )
+    return context_text, {"retrieved": tokens_before, "sent": tokens_after}
 
 
 # ---------- VIEWS ----------
 
 @ensure_csrf_cookie
 @login_required
+@metrics.timed_view("home")
 def home(request):
     user = request.user
     participant = get_or_create_participant(user)
 
-    qa = load_ground_truth()
-    idx = max(0, min(participant.current_q_index, len(qa) - 1))
-    main_question = qa[idx]["question"]
+    topic = topic_for(participant)
+    idx, main_question, _ = topic.question(participant.current_q_index)
+
+    # Get a thread ready before the first message arrives
+    if not participant.current_thread_id:
+        thread_pool.prefetch(opening_message_for(participant))
 
     return render(
         request,
         "a2chatbot/welcome.html",
         {
             "user": user,
-            "all_questions": qa,
+            "all_questions": topic.qa,
+            "topic": topic,
+            "topics": topic_registry.available(),
             "current_question": main_question,
             "current_index": idx,
             "mode": participant.mode,   
@@ -490,26 +601,91 @@ def home(request):
 
 
 @login_required
+@metrics.timed_view("sendmessage")
 def sendmessage(request):
     if request.method == "POST":
         user = request.user
         participant = get_or_create_participant(user)
 
-        mode = participant.mode
         studentmessage = request.POST["message"]
+        key = request.POST.get("idempotency_key") or None
+        usage.begin(user)
+
+        # A retry of a request we've already seen: replay it
+        if key:
+            previous = turns.find_turn(user, key)
+            if previous is not None:
+                if previous.status == "done":
+                    return JsonResponse(previous.response, safe=False)
+                return pending_response()
+
+        # Only one turn per participant (and thread) at a time
+        lease = turns.acquire_lease(participant)
+        if lease is None:
+            return busy_response()
+        try:
+            if key and not turns.start_turn(user, key):
+                return pending_response()
+
+            # Pick up thread/assistant changes made by the previous turn
+            participant.refresh_from_db()
+            budget = usage.budget_state(user)
+
+            # Branch on mode
+            try:
+                if participant.mode == "tutor_asks":
+                    response = handle_tutor_mode(request, participant, studentmessage, budget)
+                else:
+                    response = handle_student_mode(request, participant, studentmessage, budget)
+            except admission.Overloaded as e:
+                response = overloaded_response(e)
+            except turns.LeaseLost:
+                response = busy_response()
+            except Exception:
+                if key:
+                    turns.abandon_turn(user, key)
+                raise
+
+            if key:
+                if response.status_code == 200:
+                    turns.finish_turn(user, key, json.loads(response.content))
+                else:
+                    turns.abandon_turn(user, key)
+            return response
+        finally:
+            turns.release_lease(participant, lease)
+            # Tokens spent before an error or rejection count too
+            usage.flush(user)
+
+
+def pending_response():
+    # Same idempotency key still running: poll again with the same key
+    return JsonResponse({"status": "pending", "retry_after": 2}, status=202)
+
+
+def busy_response():
+    response = JsonResponse(
+        {"error": "Your previous message is still being answered.", "retry_after": 2},
+        status=409,
+    )
+    response["Retry-After"] = "2"
+    return response
 
-        # Branch on mode
-        if mode == "tutor_asks":
-            return handle_tutor_mode(request, participant, studentmessage)
-        else:
-            return handle_student_mode(request, participant, studentmessage)
 
+def overloaded_response(exc):
+    response = JsonResponse(
+        {"error": "The tutor is very busy right now.", "retry_after": exc.retry_after},
+        status=429,
+    )
+    response["Retry-After"] = str(exc.retry_after)
+    return response
 
 
 def landing(request):
     return render(request, "a2chatbot/landing.html")
 
 
+@metrics.timed_view("register")
 def register(request):
     if request.method == "POST":
         username = request.POST.get("username")
@@ -517,105 +693,192 @@ def register(request):
         level = request.POST.get("level")
         summary = request.POST.get("summary", "").strip()
 
-        user = User.objects.create_user(username=username, password=password)
-
-        # Build persona once
-        persona_text = build_persona(level, summary)
-        participant = Participant.objects.create(
-            user=user,
-            level=level,
-            persona=persona_text,
-            current_q_index=0,
-            assistant_id = None,
-            current_thread_id=None
-        )
+        # Build persona once (before creating the user, so a rejected
+        # call doesn't leave an account without a Participant)
+        topic = get_topic()
+        usage.begin()
+        try:
+            persona_text = build_persona(level, summary, topic)
+        except admission.Overloaded as e:
+            return render(
+                request,
+                "a2chatbot/register.html",
+                {"message": f"The tutor is very busy right now. Please try again in {e.retry_after} seconds."},
+                status=429,
+            )
+
+        with metrics.span("create_user"):
+            user = User.objects.create_user(username=username, password=password)
+        usage.flush(user)
+
+        with metrics.span("participant_create"):
+            participant = Participant.objects.create(
+                user=user,
+                level=level,
+                persona=persona_text,
+                current_q_index=0,
+                assistant_id = None,
+                current_thread_id=None,
+                topic=topic.name,
+            )
         login(request, user)
         return redirect("home")
 
     return render(request, "a2chatbot/register.html")
 
 @login_required
+@metrics.timed_view("switch_mode")
 def switch_mode(request, mode):
     participant = get_or_create_participant(request.user)
 
     if mode in ["tutor_asks", "student_asks"]:
         participant.mode = mode
         # reset assistant & thread for clean mode switching
+        # (old ones are deleted in the background)
         if participant.assistant_id:
-            try:
-                client.beta.assistants.delete(participant.assistant_id)
-            except:
-                pass
+            background(openai_call, "assistant_delete", client.beta.assistants.delete,
+                       priority=admission.PREFETCH, assistant_id=participant.assistant_id)
         participant.assistant_id = None
 
-        if participant.current_thread_id:
-            try:
-                client.beta.threads.delete(participant.current_thread_id)
-            except:
-                pass
-        participant.current_thread_id = None
-
-        participant.save()
+        reset_thread(participant)
+        participant.save(update_fields=["mode", "assistant_id", "current_thread_id", "updated_at"])
 
     return redirect("home")
 
 @login_required
+@metrics.timed_view("next_question")
 def next_question(request):
     user = request.user
     participant = get_or_create_participant(user)
 
-    # Delete assistant
-    if participant.assistant_id:
-        try:
-            client.beta.assistants.delete(participant.assistant_id)
-        except Exception as e:
-            print("[WARN] Failed to delete assistant:", e)
-        participant.assistant_id = None
-
-    # Delete thread
-    if participant.current_thread_id:
-        try:
-            client.beta.threads.delete(participant.current_thread_id)
-        except Exception as e:
-            print("[WARN] Failed to delete thread:", e)
-        participant.current_thread_id = None
-
     # Move to next question
-    qa = load_ground_truth()
+    qa = topic_for(participant).qa
     if participant.current_q_index < len(qa) - 1:
         participant.current_q_index += 1
     # else remain at last question
 
-    participant.save()
+    # Fresh thread per question. The assistant is kept: its instructions
+    # don't depend on the question.
+    reset_thread(participant)
+
+    participant.save(update_fields=["current_q_index", "current_thread_id", "updated_at"])
     return redirect("home")
 
 @login_required
+@metrics.timed_view("set_question")
 def set_question(request, idx):
     user = request.user
     participant = get_or_create_participant(user)
 
-    qa = load_ground_truth()
+    qa = topic_for(participant).qa
 
     # validate index
     if 0 <= idx < len(qa):
         participant.current_q_index = idx
 
-        # delete assistant (fresh start per question)
-        if participant.assistant_id:
-            try:
-                client.beta.assistants.delete(participant.assistant_id)
-            except:
-                pass
-            participant.assistant_id = None
+        # fresh thread per question (assistant is kept)
+        reset_thread(participant)
 
-        # delete thread
-        if participant.current_thread_id:
-            try:
-                client.beta.threads.delete(participant.current_thread_id)
-            except:
-                pass
-            participant.current_thread_id = None
+        participant.save(update_fields=["current_q_index", "current_thread_id", "updated_at"])
+
+    return redirect("home")
+
+@login_required
+@metrics.timed_view("switch_topic")
+def switch_topic(request, name):
+    participant = get_or_create_participant(request.user)
+
+    if name in topic_registry.available() and name != participant.topic:
+        participant.topic = name
+        participant.current_q_index = 0
+        # the assistant's instructions name the topic, so start afresh
+        if participant.assistant_id:
+            background(openai_call, "assistant_delete", client.beta.assistants.delete,
+                       priority=admission.PREFETCH, assistant_id=participant.assistant_id)
+        participant.assistant_id = None
 
-        participant.save()
+        reset_thread(participant)
+        participant.save(update_fields=["topic", "current_q_index", "assistant_id", "current_thread_id", "updated_at"])
 
     return redirect("home")
+
+
+# ---------- Chat history ----------
+
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+
+def encode_history_cursor(turn):
+    raw = f"{turn['timestamp'].isoformat()}|{turn['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_history_cursor(cursor):
+    """
+    Return (timestamp, id) from a cursor, or raise ValueError.
+    """
+    raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    timestamp, turn_id = raw.split("|")
+    return datetime.fromisoformat(timestamp), int(turn_id)
+
+
+@login_required
+@metrics.timed_view("history")
+def history(request):
+    """
+    A page of turns, newest first, keyset-paginated on (timestamp, id).
+    Pass the returned `next` cursor as ?before=... for the previous page.
+    Retrieval context is left out; fetch it per turn from history_context.
+    Staff can read another participant's history with ?user=<id>.
+    """
+    user_id = request.user.id
+    if request.user.is_staff and request.GET.get("user"):
+        user_id = request.GET["user"]
+
+    try:
+        limit = max(1, min(int(request.GET.get("limit", HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE))
+        logs = ChatLog.objects.filter(user_id=user_id)
+        if request.GET.get("before"):
+            timestamp, turn_id = decode_history_cursor(request.GET["before"])
+            logs = logs.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=turn_id))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid limit or cursor")
+
+    with metrics.span("history_query"):
+        rows = list(
+            logs.order_by("-timestamp", "-id")
+            .values("id", "timestamp", "message", "bot_reply", mode=KeyTextTransform("mode", "meta"))[:limit + 1]
+        )
+
+    next_cursor = encode_history_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return JsonResponse({
+        "turns": [
+            {
+                "id": row["id"],
+                "timestamp": row["timestamp"].isoformat(),
+                "message": row["message"],
+                "bot_message": row["bot_reply"],
+                "mode": row["mode"],
+            }
+            for row in rows[:limit]
+        ],
+        "next": next_cursor,
+    })
+
+
+@login_required
+def history_context(request, turn_id):
+    """
+    Retrieval context of one turn, loaded when the student expands it.
+    """
+    logs = ChatLog.objects.all() if request.user.is_staff else ChatLog.objects.filter(user=request.user)
+    turn = get_object_or_404(logs.only("id", "context"), pk=turn_id)
+    return JsonResponse({"id": turn.id, "rag_context": turn.context or ""})
+
+
+def prometheus_metrics(request):
+    """
+    Expose stage and view latency histograms in Prometheus text format.
+    """
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,148 @@
+"""
+Warm pool of pre-created assistant threads.
+
+A thread's only per-question state is its opening message, which does not
+depend on the participant, so threads can be created ahead of time, keyed by
+that opening message, and handed to whoever needs one. Creating, prefetching
+and deleting threads all happen on a small background executor so they stay
+off the request path.
+
+Ready threads that nobody takes within `ttl` seconds are deleted, at most
+`max_ready` are kept across all keys (oldest deleted first), and whatever is
+still ready when the process exits is deleted too.
+"""
+
+import atexit
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="warmpool")
+
+
+def background(fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) on the background executor, logging failures.
+    """
+    def run():
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            print(f"[WARN] Background {getattr(fn, '__name__', fn)} failed:", e)
+    _executor.submit(run)
+
+
+class WarmThreadPool:
+    def __init__(self, factory, size=1, discard=None, ttl=900.0, max_ready=50):
+        # factory(opening_message) -> thread_id; discard(thread_id) deletes it
+        self.factory = factory
+        self.discard = discard
+        self.size = size
+        self.ttl = ttl
+        self.max_ready = max_ready
+        self._lock = threading.Lock()
+        self._ready = defaultdict(deque)  # key -> deque of (created_at, thread_id)
+        self._pending = defaultdict(int)
+        self._last_taken = {}
+        atexit.register(self.drain)
+
+    def take(self, key):
+        """
+        Return a ready thread id for `key` (or None). The pool is only topped
+        back up for keys that were asked for before within `ttl`, so one-off
+        keys don't keep a spare thread around.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = self._expire(now)
+            ready = self._ready[key]
+            thread_id = ready.popleft()[1] if ready else None
+            if not ready:
+                del self._ready[key]
+            recently_used = now - self._last_taken.get(key, float("-inf")) < self.ttl
+            self._last_taken[key] = now
+        self._discard(expired)
+        if recently_used:
+            self.prefetch(key)
+        return thread_id
+
+    def prefetch(self, key):
+        """
+        Start creating threads for `key` until `size` are ready or in flight.
+        """
+        with self._lock:
+            expired = self._expire(time.monotonic())
+            missing = self.size - len(self._ready.get(key, ())) - self._pending.get(key, 0)
+            if missing > 0:
+                expired += self._make_room(missing)
+                missing = min(missing, self.max_ready - self._in_pool())
+            if missing > 0:
+                self._pending[key] += missing
+        self._discard(expired)
+        for _ in range(max(0, missing)):
+            _executor.submit(self._create, key)
+
+    def drain(self):
+        """
+        Delete every ready thread (at process exit).
+        """
+        with self._lock:
+            ids = [thread_id for ready in self._ready.values() for _, thread_id in ready]
+            self._ready.clear()
+        if self.discard is not None:
+            for thread_id in ids:
+                try:
+                    self.discard(thread_id)
+                except Exception as e:
+                    print("[WARN] Failed to delete pooled thread:", e)
+
+    def _create(self, key):
+        thread_id = None
+        try:
+            thread_id = self.factory(key)
+        except Exception as e:
+            print("[WARN] Failed to prefetch thread:", e)
+        with self._lock:
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+            if thread_id:
+                self._ready[key].append((time.monotonic(), thread_id))
+
+    # The helpers below are called with the lock held and return thread ids
+    # to hand to _discard once it is released.
+
+    def _expire(self, now):
+        expired = []
+        for key in list(self._ready):
+            ready = self._ready[key]
+            while ready and now - ready[0][0] >= self.ttl:
+                expired.append(ready.popleft()[1])
+            if not ready:
+                del self._ready[key]
+        for key in [k for k, t in self._last_taken.items() if now - t >= self.ttl]:
+            del self._last_taken[key]
+        return expired
+
+    def _make_room(self, needed):
+        """
+        Evict the oldest ready threads until `needed` more fit under max_ready.
+        """
+        evicted = []
+        in_pool = self._in_pool()
+        while in_pool + needed > self.max_ready and self._ready:
+            key = min(self._ready, key=lambda k: self._ready[k][0][0])
+            evicted.append(self._ready[key].popleft()[1])
+            if not self._ready[key]:
+                del self._ready[key]
+            in_pool -= 1
+        return evicted
+
+    def _in_pool(self):
+        return sum(len(r) for r in self._ready.values()) + sum(self._pending.values())
+
+    def _discard(self, thread_ids):
+        if self.discard is not None:
+            for thread_id in thread_ids:
+                background(self.discard, thread_id)